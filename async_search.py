@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from aiobotocore.session import get_session
+from botocore.config import Config
+from elasticsearch import AsyncElasticsearch
+import utils
+from utils import (
+    ES_ENDPOINT, ES_API_KEY, multimodal_embed_model, embedding_cache, result_cache, make_namespace,
+    _s3_query_request, _es_knn_query, _es_results, ES_SOURCE_FIELDS,
+)
+from embedding_cache import EmbeddingCache, normalize_text
+from image_io import EMBED_IMAGE_MAX_SIDE, fetch_image_bytes, prepare_image_bytes, titan_request_body
+from tracing import span, tracer
+
+S3_VECTOR_BUCKET_NAME = os.environ.get("S3_VECTOR_BUCKET_NAME")
+S3_VECTOR_INDEX_NAME = os.environ.get("S3_VECTOR_INDEX_NAME")
+ES_INDEX_NAME = os.environ.get("ES_INDEX_NAME", "fashion-products-index")
+
+ENGINES = ("S3", "Elasticsearch", "Local", "IVF", "Two-stage")
+DEFAULT_CONCURRENCY = 16
+DEFAULT_TIMEOUT = 30.0  # seconds per query, embedding included
+
+
+class AsyncSearchClient:
+    """Async Bedrock, S3 Vectors and Elasticsearch clients sharing one connection pool each.
+
+    Use as an async context manager; search_many() embeds and queries many
+    text/image queries concurrently, at most `concurrency` at a time.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 vector_bucket_name=S3_VECTOR_BUCKET_NAME, s3_index_name=S3_VECTOR_INDEX_NAME,
+                 es_index_name=ES_INDEX_NAME, dataset_path=None, ivf_index_path=None, nprobe=None, candidates=None, use_cache=True):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.vector_bucket_name = vector_bucket_name
+        self.s3_index_name = s3_index_name
+        self.es_index_name = es_index_name
+        self.dataset_path = dataset_path
+        self.ivf_index_path = ivf_index_path
+        self.nprobe = nprobe
+        self.candidates = candidates
+        self.use_cache = use_cache
+        self.bedrock = None
+        self.s3vectors = None
+        self.s3 = None
+        self.es = None
+        self._contexts = []
+
+    async def __aenter__(self):
+        session = get_session()
+        config = Config(max_pool_connections=self.concurrency)
+        for name in ("bedrock-runtime", "s3vectors", "s3"):
+            context = session.create_client(name, region_name=utils.region, config=config)
+            client = await context.__aenter__()
+            self._contexts.append(context)
+            setattr(self, name.replace("-runtime", ""), client)
+        if ES_ENDPOINT and ES_API_KEY:
+            self.es = AsyncElasticsearch(ES_ENDPOINT, api_key=ES_API_KEY, connections_per_node=self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.es is not None:
+            await self.es.close()
+        for context in reversed(self._contexts):
+            await context.__aexit__(*exc_info)
+        self._contexts = []
+
+    async def search_many(self, queries, k, engine="S3", filters=None):
+        """Search every query concurrently; one {"results", "query_time_ms", "embedding_ms", "error"} per query, in input order.
+
+        A query is a text string or a dict with "text", "image" and/or a precomputed "embedding".
+        A failed or timed-out query reports its error without affecting the others.
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}; choose from {', '.join(ENGINES)}")
+        # Load or build an in-process index once up front, outside the per-query timeout;
+        # if that fails (e.g. no dataset), each query reports the error itself
+        try:
+            await asyncio.to_thread(self._warm_index, engine)
+        except Exception:
+            pass
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(query):
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(self.search(query, k, engine, filters), self.timeout)
+                except asyncio.TimeoutError:
+                    return _outcome(error=f"timed out after {self.timeout:g}s")
+                except Exception as e:
+                    return _outcome(error=str(e))
+
+        return await asyncio.gather(*(run(query) for query in queries))
+
+    async def search(self, query, k, engine="S3", filters=None):
+        query = {"text": query} if isinstance(query, str) else query
+        embed_start = time.time()
+        query_emb = query.get("embedding")
+        if query_emb is None:
+            query_emb = await self.embed(image_path=query.get("image"), description=query.get("text"), use_cache=self.use_cache)
+        embedding_ms = (time.time() - embed_start) * 1000
+
+        namespace = make_namespace(engine, self._index_label(engine), k, filters)
+        if self.use_cache:
+            with span("result_cache"):
+                cached = result_cache.get(namespace, query_emb)
+            if cached is not None:
+                return _outcome(cached, 0.0, embedding_ms)
+
+        if engine == "S3":
+            results, query_time_ms = await self._query_s3(query_emb, k, filters)
+        elif engine == "Elasticsearch":
+            results, query_time_ms = await self._query_es(query_emb, k, filters)
+        elif engine == "Local":
+            # CPU-bound in-process search; keep it off the event loop
+            results, query_time_ms = await asyncio.to_thread(utils._query_local, query_emb, k, self.dataset_path, filters)
+        elif engine == "IVF":
+            results, query_time_ms = await asyncio.to_thread(utils._query_ivf, query_emb, k, self.ivf_index_path, self.nprobe, filters, self.dataset_path)
+        else:
+            results, query_time_ms = await asyncio.to_thread(utils._query_two_stage, query_emb, k, self.dataset_path, self.candidates, filters)
+
+        if self.use_cache:
+            result_cache.put(namespace, query_emb, results)
+        return _outcome(results, query_time_ms, embedding_ms)
+
+    async def embed(self, image_path=None, description=None, dimension=1024, model_id=multimodal_embed_model,
+                    max_side=EMBED_IMAGE_MAX_SIDE, use_cache=True):
+        """Titan Multimodal embedding, sharing the embedding cache and image downscaling with the synchronous path.
+
+        The cache may read, write and evict files on disk, so it is accessed from a worker thread.
+        """
+        image_bytes = None
+        if image_path is not None:
+            with span("image_load"):
+                image_bytes = await self._read_image_bytes(image_path)
+        description = normalize_text(description)
+
+        cache_key = EmbeddingCache.make_key(f"{model_id}@{max_side}", dimension, description, image_bytes)
+        if use_cache:
+            cached = await asyncio.to_thread(embedding_cache.get, cache_key)
+            if cached is not None:
+                return cached["embedding"]
+        if image_bytes:
+            # Resizing is CPU work; keep it off the event loop
+            with span("resize"):
+                image_bytes = await asyncio.to_thread(prepare_image_bytes, image_bytes, max_side)
+        body = titan_request_body(image_bytes, description, dimension)
+
+        with span("embed"):
+            response = await self.bedrock.invoke_model(
+                body=body, modelId=model_id, accept="application/json", contentType="application/json"
+            )
+            async with response["body"] as stream:
+                result = json.loads(await stream.read())
+        if use_cache:
+            await asyncio.to_thread(embedding_cache.put, cache_key, result)
+        return result["embedding"]
+
+    async def _read_image_bytes(self, image_path):
+        if isinstance(image_path, (bytes, bytearray, memoryview)):
+            return bytes(image_path)
+        if image_path.startswith('s3'):
+            bucket_name, key = image_path.replace("s3://", "").split("/", 1)
+            obj = await self.s3.get_object(Bucket=bucket_name, Key=key)
+            async with obj["Body"] as stream:
+                return await stream.read()
+        # Local files and URLs go through the pooled synchronous fetcher in a worker thread
+        return await asyncio.to_thread(fetch_image_bytes, image_path)
+
+    async def _query_s3(self, query_emb, k, filters):
+        start_time = time.time()
+        response = await self.s3vectors.query_vectors(
+            **_s3_query_request(list(map(float, query_emb)), k, self.vector_bucket_name, self.s3_index_name, filters)
+        )
+        query_time_ms = (time.time() - start_time) * 1000
+        tracer.record("search", query_time_ms)
+        return response["vectors"], query_time_ms
+
+    async def _query_es(self, query_emb, k, filters):
+        if self.es is None:
+            raise ConnectionError("Elasticsearch client not configured. Check your .env file for ES_ENDPOINT and ES_API_KEY.")
+        start_time = time.time()
+        response = await self.es.search(
+            index=self.es_index_name,
+            knn=_es_knn_query(list(map(float, query_emb)), k, filters),
+            source=ES_SOURCE_FIELDS,
+            size=k
+        )
+        query_time_ms = (time.time() - start_time) * 1000
+        tracer.record("search", query_time_ms)
+        return _es_results(response), query_time_ms
+
+    def _warm_index(self, engine):
+        if engine == "Local":
+            utils.get_local_index(self.dataset_path)
+        elif engine == "IVF":
+            utils.get_ivf_index(self.ivf_index_path, self.dataset_path)
+        elif engine == "Two-stage":
+            utils.get_two_stage_index(self.dataset_path)
+
+    def _index_label(self, engine):
+        """Same namespaces as the synchronous helpers, so both paths share the result cache."""
+        if engine == "S3":
+            return f"{self.vector_bucket_name}/{self.s3_index_name}"
+        if engine == "Elasticsearch":
+            return self.es_index_name
+        if engine == "Local":
+            return self.dataset_path or utils.LOCAL_DATASET_PATH
+        if engine == "IVF":
+            return (self.ivf_index_path or utils.IVF_INDEX_PATH, self.nprobe, self.dataset_path or utils.LOCAL_DATASET_PATH)
+        return (self.dataset_path or utils.LOCAL_DATASET_PATH, utils.COARSE_DIMENSION, utils.COARSE_INT8, self.candidates)
+
+
+def _outcome(results=None, query_time_ms=None, embedding_ms=None, error=None):
+    return {"results": results or [], "query_time_ms": query_time_ms, "embedding_ms": embedding_ms, "error": error}
+
+async def search_many(queries, k, engine="S3", filters=None, client=None, **client_options):
+    """Embed and search many queries concurrently and return their outcomes in input order.
+
+    Pass an open AsyncSearchClient to reuse its connection pools across calls;
+    otherwise one is opened for this batch with `client_options`.
+    """
+    if client is not None:
+        return await client.search_many(queries, k, engine, filters)
+    async with AsyncSearchClient(**client_options) as client:
+        return await client.search_many(queries, k, engine, filters)
+
+def main():
+    from benchmark import load_queries
+
+    parser = argparse.ArgumentParser(description="Run a batch of text/image queries concurrently and write the results as JSON lines.")
+    parser.add_argument("queries", help="query file: JSON lines with text/image/embedding, or one text query per line")
+    parser.add_argument("--engine", choices=ENGINES, default="S3")
+    parser.add_argument("-k", "--k", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds per query")
+    parser.add_argument("--filters", type=json.loads, default=None, help='JSON object, e.g. \'{"gender": "Women"}\'')
+    parser.add_argument("--output", help="JSON lines output (default: stdout)")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    start_time = time.time()
+    outcomes = asyncio.run(search_many(queries, args.k, args.engine, args.filters,
+                                       concurrency=args.concurrency, timeout=args.timeout))
+    elapsed = time.time() - start_time
+
+    lines = [json.dumps({"query": {key: value for key, value in query.items() if key != "embedding"}, **outcome}, default=str)
+             for query, outcome in zip(queries, outcomes)]
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+    errors = sum(1 for outcome in outcomes if outcome["error"])
+    print(f"{len(queries)} queries in {elapsed:.2f} seconds ({len(queries) / elapsed if elapsed else 0:.1f} queries/sec), {errors} errors", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
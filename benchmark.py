@@ -0,0 +1,357 @@
+import os
+import csv
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timezone
+import numpy as np
+from dotenv import load_dotenv
+from local_search import LocalVectorIndex
+from ivf_index import IVFIndex, dataset_identity, npz_path
+from two_stage_index import TwoStageIndex, DEFAULT_COARSE_DIMENSION
+from dataset import is_snapshot
+
+load_dotenv()
+S3_VECTOR_BUCKET_NAME = os.environ.get("S3_VECTOR_BUCKET_NAME")
+S3_VECTOR_INDEX_NAME = os.environ.get("S3_VECTOR_INDEX_NAME")
+ES_INDEX_NAME = os.environ.get("ES_INDEX_NAME", "fashion-products-index")
+LOCAL_DATASET_PATH = os.environ.get("LOCAL_DATASET_PATH", "dataset.csv")
+IVF_INDEX_PATH = os.environ.get("IVF_INDEX_PATH", "./data/ivf_index.npz")
+
+CSV_FIELDS = [
+    "timestamp", "backend", "k", "concurrency", "queries", "requests", "errors", "duration_seconds",
+    "qps", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms", "recall_at_k", "ndcg_at_k",
+]
+
+
+class S3VectorsBackend:
+    """Query an S3 Vectors index through a (possibly stubbed) s3vectors client."""
+
+    def __init__(self, client, vector_bucket_name, index_name, name="s3"):
+        self.client = client
+        self.vector_bucket_name = vector_bucket_name
+        self.index_name = index_name
+        self.name = name
+
+    def search(self, query_emb, k):
+        response = self.client.query_vectors(
+            vectorBucketName=self.vector_bucket_name,
+            indexName=self.index_name,
+            queryVector={"float32": list(map(float, query_emb))},
+            topK=k,
+            returnDistance=True,
+            returnMetadata=False
+        )
+        return [vector['key'] for vector in response["vectors"]]
+
+
+class ElasticsearchBackend:
+    """Query an Elasticsearch kNN index through a (possibly stubbed) client."""
+
+    def __init__(self, client, index_name, num_candidates=100, name="es"):
+        self.client = client
+        self.index_name = index_name
+        self.num_candidates = num_candidates
+        self.name = name
+
+    def search(self, query_emb, k):
+        response = self.client.search(
+            index=self.index_name,
+            knn={
+                "field": "embedding_img",
+                "query_vector": list(map(float, query_emb)),
+                "k": k,
+                "num_candidates": max(k, self.num_candidates)
+            },
+            source=["id"],
+            size=k
+        )
+        return [str(hit['_source']['id']) for hit in response['hits']['hits']]
+
+
+class LocalBackend:
+    """Query an in-process index (exact LocalVectorIndex or any object with the same search())."""
+
+    def __init__(self, index, name="local"):
+        self.index = index
+        self.name = name
+        self.memory_bytes = index.vectors.nbytes
+
+    def search(self, query_emb, k):
+        return [result['key'] for result in self.index.search(query_emb, k)]
+
+
+class IVFBackend:
+    """Query an IVFIndex at a fixed nprobe."""
+
+    def __init__(self, index, nprobe, name=None):
+        self.index = index
+        self.nprobe = nprobe
+        self.name = name or f"ivf(nprobe={nprobe})"
+        self.memory_bytes = index.vectors[:len(index)].nbytes + index.centroids.nbytes
+
+    def search(self, query_emb, k):
+        return [result['key'] for result in self.index.search(query_emb, k, nprobe=self.nprobe)]
+
+
+class TwoStageBackend:
+    """Query a TwoStageIndex with a fixed number of rerank candidates."""
+
+    def __init__(self, index, candidates, name=None):
+        self.index = index
+        self.candidates = candidates
+        self.name = name or f"2stage(c={candidates})"
+        # The full matrix is only read for the candidates, so count what every query scans
+        self.memory_bytes = index.memory_bytes()["coarse"]
+
+    def search(self, query_emb, k):
+        return [result['key'] for result in self.index.search(query_emb, k, candidates=self.candidates)]
+
+
+BACKEND_FACTORIES = {}
+
+def register_backend(name):
+    """Register a factory building a backend from the parsed CLI arguments."""
+    def decorator(factory):
+        BACKEND_FACTORIES[name] = factory
+        return factory
+    return decorator
+
+@register_backend("s3")
+def _s3_backend(args, ground_truth_index):
+    from utils import s3vectors
+    return S3VectorsBackend(s3vectors, args.bucket, args.s3_index)
+
+@register_backend("es")
+def _es_backend(args, ground_truth_index):
+    from utils import es_client
+    if not es_client:
+        raise ConnectionError("Elasticsearch client not configured. Check your .env file for ES_ENDPOINT and ES_API_KEY.")
+    return ElasticsearchBackend(es_client, args.es_index, args.num_candidates)
+
+@register_backend("local")
+def _local_backend(args, ground_truth_index):
+    return LocalBackend(ground_truth_index)
+
+@register_backend("ivf")
+def _ivf_backends(args, ground_truth_index):
+    """One backend per --nprobe value, sharing a single IVF index (loaded if built from --dataset, otherwise rebuilt)."""
+    index = IVFIndex.load(args.ivf_index) if os.path.exists(npz_path(args.ivf_index)) and not args.nlist else None
+    if index is None or index.source != dataset_identity(args.dataset):
+        print(f"Building IVF index over {len(ground_truth_index)} vectors...")
+        index = IVFIndex.build(ground_truth_index.ids, ground_truth_index.vectors, ground_truth_index.metadata, nlist=args.nlist)
+    return [IVFBackend(index, int(nprobe)) for nprobe in args.nprobe.split(",") if nprobe.strip()]
+
+@register_backend("twostage")
+def _two_stage_backends(args, ground_truth_index):
+    """One backend per --candidates value, sharing one coarse index (the snapshot's coarse/ if it matches)."""
+    quantize = not args.coarse_float32
+    if is_snapshot(args.dataset):
+        index = TwoStageIndex.from_path(args.dataset, args.coarse_dim, quantize)
+    else:
+        print(f"Building {args.coarse_dim}-d coarse index over {len(ground_truth_index)} vectors...")
+        index = TwoStageIndex.build(ground_truth_index.ids, ground_truth_index.vectors, ground_truth_index.metadata,
+                                    args.coarse_dim, quantize)
+    return [TwoStageBackend(index, int(candidates)) for candidates in args.candidates.split(",") if candidates.strip()]
+
+
+def load_queries(path):
+    """Read a query file: JSON lines with "text", "image" and/or "embedding", or plain text lines."""
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                queries.append(json.loads(line))
+            else:
+                queries.append({"text": line})
+    return queries
+
+def sample_queries(index, count, seed=0):
+    """Use catalog vectors as queries so a run needs no embedding calls at all."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index), size=min(count, len(index)), replace=False)
+    return [{"id": str(index.ids[row]), "embedding": np.asarray(index.vectors[row], dtype=np.float32)} for row in rows]
+
+def embed_queries(queries):
+    """Attach an embedding to every query that does not already carry one."""
+    needs_embedding = [q for q in queries if q.get("embedding") is None]
+    if needs_embedding:
+        from utils import get_titan_multimodal_embedding
+        for query in needs_embedding:
+            query["embedding"] = get_titan_multimodal_embedding(
+                image_path=query.get("image"), description=query.get("text"), dimension=1024
+            )["embedding"]
+    return np.asarray([q["embedding"] for q in queries], dtype=np.float32)
+
+def recall_at_k(retrieved, relevant):
+    if not relevant:
+        return 0.0
+    return len(set(retrieved) & set(relevant)) / len(relevant)
+
+def ndcg_at_k(retrieved, relevant):
+    """Binary-relevance nDCG of a ranked list against the exact top-k."""
+    relevant = set(relevant)
+    dcg = sum(1.0 / np.log2(rank + 2) for rank, key in enumerate(retrieved) if key in relevant)
+    ideal = sum(1.0 / np.log2(rank + 2) for rank in range(len(relevant)))
+    return dcg / ideal if ideal else 0.0
+
+def latency_summary(latencies_ms):
+    if not latencies_ms:
+        return {"mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    values = np.asarray(latencies_ms)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "mean_ms": float(values.mean()), "p50_ms": float(p50), "p95_ms": float(p95),
+        "p99_ms": float(p99), "max_ms": float(values.max()),
+    }
+
+def run_load(backend, query_embs, k, concurrency=1, duration=0.0):
+    """Replay queries against one backend from `concurrency` threads.
+
+    With duration=0 every query is sent exactly once; otherwise the query list is
+    replayed round-robin until the duration has elapsed. Returns the per-request
+    latencies, the error count, the wall time and the first result list of each query.
+    """
+    latencies_ms, errors = [], 0
+    first_results = [None] * len(query_embs)
+    lock = threading.Lock()
+    next_query = [0]
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                position = next_query[0]
+                next_query[0] += 1
+            if deadline is None and position >= len(query_embs):
+                return
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            query_position = position % len(query_embs)
+            request_start = time.perf_counter()
+            try:
+                keys = backend.search(query_embs[query_position], k)
+            except Exception as e:
+                with lock:
+                    errors += 1
+                    if errors == 1:
+                        print(f"{backend.name}: query failed: {e}")
+                continue
+            elapsed_ms = (time.perf_counter() - request_start) * 1000
+            with lock:
+                latencies_ms.append(elapsed_ms)
+                if first_results[query_position] is None:
+                    first_results[query_position] = keys
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies_ms, errors, time.perf_counter() - start, first_results
+
+def benchmark_backend(backend, query_embs, truth, k, concurrency=1, duration=0.0):
+    """Load-test one backend and score its results against the exact ground truth."""
+    latencies_ms, errors, wall_time, results = run_load(backend, query_embs, k, concurrency, duration)
+    scored = [(retrieved, relevant) for retrieved, relevant in zip(results, truth) if retrieved is not None]
+    report = {
+        "backend": backend.name,
+        "k": k,
+        "concurrency": concurrency,
+        "queries": len(query_embs),
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "duration_seconds": wall_time,
+        "qps": len(latencies_ms) / wall_time if wall_time else 0.0,
+        "recall_at_k": float(np.mean([recall_at_k(r, t) for r, t in scored])) if scored else None,
+        "ndcg_at_k": float(np.mean([ndcg_at_k(r, t) for r, t in scored])) if scored else None,
+        "index_mb": backend.memory_bytes / 1e6 if getattr(backend, "memory_bytes", None) else None,
+    }
+    report.update(latency_summary(latencies_ms))
+    return report
+
+def ground_truth(index, query_embs, k):
+    return [[result['key'] for result in results] for results in index.search_batch(query_embs, k)]
+
+def write_results(reports, json_path=None, csv_path=None, run_info=None):
+    """Write a run as JSON and append one row per backend to a CSV history file."""
+    timestamp = datetime.now(timezone.utc).isoformat()
+    if json_path:
+        os.makedirs(os.path.dirname(json_path) or ".", exist_ok=True)
+        with open(json_path, "w") as f:
+            json.dump({"timestamp": timestamp, "run": run_info or {}, "results": reports}, f, indent=2)
+    if csv_path:
+        new_file = not os.path.exists(csv_path)
+        with open(csv_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            if new_file:
+                writer.writeheader()
+            for report in reports:
+                writer.writerow({"timestamp": timestamp, **report})
+
+def print_report(reports):
+    header = f"{'backend':<16}{'qps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'recall':>9}{'ndcg':>9}{'index MB':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    fmt = lambda value, spec: format(value, spec) if value is not None else "-"
+    for r in reports:
+        print(f"{r['backend']:<16}{fmt(r['qps'], '10.1f')}{fmt(r['p50_ms'], '10.2f')}{fmt(r['p95_ms'], '10.2f')}"
+              f"{fmt(r['p99_ms'], '10.2f')}{fmt(r['max_ms'], '10.2f')}{fmt(r['recall_at_k'], '9.3f')}"
+              f"{fmt(r['ndcg_at_k'], '9.3f')}{fmt(r.get('index_mb'), '10.1f')}{r['errors']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test and score the vector search backends against exact ground truth.")
+    parser.add_argument("--queries", help="query file: JSON lines with text/image/embedding, or one text query per line")
+    parser.add_argument("--sample-queries", type=int, default=0, help="use N random catalog vectors as queries (offline)")
+    parser.add_argument("--dataset", default=LOCAL_DATASET_PATH, help="dataset.csv or snapshot used for exact ground truth")
+    parser.add_argument("--backends", default="local", help=f"comma-separated, from: {', '.join(BACKEND_FACTORIES)}")
+    parser.add_argument("-k", "--k", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds to replay the queries for; 0 sends each once")
+    parser.add_argument("--bucket", default=S3_VECTOR_BUCKET_NAME)
+    parser.add_argument("--s3-index", default=S3_VECTOR_INDEX_NAME)
+    parser.add_argument("--es-index", default=ES_INDEX_NAME)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--ivf-index", default=IVF_INDEX_PATH, help="saved IVF index (built from --dataset if missing)")
+    parser.add_argument("--nlist", type=int, default=None, help="build a fresh IVF index with this many lists")
+    parser.add_argument("--nprobe", default="1,2,4,8,16", help="comma-separated nprobe values to sweep for the ivf backend")
+    parser.add_argument("--coarse-dim", type=int, default=DEFAULT_COARSE_DIMENSION, help="reduced dimension for the twostage backend")
+    parser.add_argument("--coarse-float32", action="store_true", help="keep the twostage coarse vectors as float32 instead of int8")
+    parser.add_argument("--candidates", default="50,100,200,400", help="comma-separated rerank candidate counts to sweep for the twostage backend")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the run as JSON to this path")
+    parser.add_argument("--csv", help="append one row per backend to this CSV file")
+    args = parser.parse_args()
+
+    if not args.queries and not args.sample_queries:
+        parser.error("provide --queries and/or --sample-queries")
+
+    index = LocalVectorIndex.from_path(args.dataset)
+    queries = load_queries(args.queries) if args.queries else []
+    queries += sample_queries(index, args.sample_queries, args.seed) if args.sample_queries else []
+    query_embs = embed_queries(queries)
+    truth = ground_truth(index, query_embs, args.k)
+    print(f"Loaded {len(queries)} queries; ground truth from {len(index)} vectors in {args.dataset}")
+
+    reports = []
+    for name in [name.strip() for name in args.backends.split(",") if name.strip()]:
+        if name not in BACKEND_FACTORIES:
+            parser.error(f"unknown backend {name!r}; choose from {', '.join(BACKEND_FACTORIES)}")
+        backends = BACKEND_FACTORIES[name](args, index)
+        # A factory may return several configurations of one backend (e.g. an nprobe or candidates sweep)
+        for backend in backends if isinstance(backends, list) else [backends]:
+            print(f"Benchmarking {backend.name}...")
+            reports.append(benchmark_backend(backend, query_embs, truth, args.k, args.concurrency, args.duration))
+
+    print_report(reports)
+    run_info = {key: value for key, value in vars(args).items() if key not in ("output", "csv")}
+    write_results(reports, args.output, args.csv, run_info)
+
+if __name__ == "__main__":
+    main()
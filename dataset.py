@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+EMBEDDING_COLUMN = 'embedding_img'
+ID_COLUMN = 'id'
+EMBEDDING_DIMENSION = 1024
+
+# metadata key -> dataset.csv column, as written by ingest_fashion_vectors.py
+METADATA_COLUMNS = {
+    "gender": "gender",
+    "master_category": "masterCategory",
+    "sub_category": "subCategory",
+    "type": "articleType",
+    "base_color": "baseColour",
+    "season": "season",
+    "year": "year",
+    "usage": "usage",
+    "item_name_in_en_us": "productDisplayName",
+    "img_full_path": "img_full_path",
+}
+
+CSV_CHUNK_SIZE = 2000  # rows per chunk when streaming dataset.csv
+
+def parse_embedding(value):
+    """Parse a stringified embedding ("[0.1, 0.2, ...]") into a float32 array, or None if missing."""
+    if not isinstance(value, str) or not value.lstrip().startswith('['):
+        return None
+    return np.fromstring(value.strip().strip('[]'), sep=',', dtype=np.float32)
+
+def parse_embedding_column(values):
+    """Parse a column of stringified embeddings in one pass.
+
+    Returns (matrix, positions) where positions are the row offsets that held a valid
+    embedding; rows that are missing or do not match the common dimension are dropped.
+    """
+    values = pd.Series(values, dtype=object).reset_index(drop=True)
+    text = values.where(values.map(lambda v: isinstance(v, str)), "").str.strip()
+    valid = text.str.startswith('[')
+    positions = np.flatnonzero(valid.to_numpy())
+    if not len(positions):
+        return np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32), positions
+
+    bodies = text[valid].str.strip('[]')
+    flat = np.fromstring(",".join(bodies), sep=',', dtype=np.float32)
+    dimension = len(parse_embedding(text[positions[0]]))
+    if flat.size == len(positions) * dimension:
+        return flat.reshape(len(positions), dimension), positions
+
+    # Some row is malformed or has a different length: fall back to parsing row by row
+    rows, kept = [], []
+    for position in positions:
+        embedding = parse_embedding(text[position])
+        if embedding is not None and len(embedding) == dimension:
+            rows.append(embedding)
+            kept.append(position)
+    return np.vstack(rows), np.asarray(kept, dtype=np.int64)
+
+def metadata_from_frame(frame):
+    """Column-wise metadata extraction with "unknown" for missing values."""
+    metadata = {}
+    for key, column in METADATA_COLUMNS.items():
+        values = frame[column]
+        metadata[key] = values.astype(str).where(values.notna(), "unknown").tolist()
+    return metadata
+
+def iter_dataset_chunks(path, chunksize=CSV_CHUNK_SIZE):
+    """Stream dataset.csv as (ids, float32 embedding matrix, columnar metadata, skipped row numbers) per chunk.
+
+    Memory stays bounded by the chunk size regardless of the catalog size.
+    """
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        matrix, positions = parse_embedding_column(chunk[EMBEDDING_COLUMN])
+        kept = chunk.iloc[positions]
+        skipped = np.setdiff1d(chunk.index.to_numpy(), kept.index.to_numpy())
+        ids = kept[ID_COLUMN].astype(str).to_numpy()
+        yield ids, np.ascontiguousarray(matrix, dtype=np.float32), metadata_from_frame(kept), skipped
+
+def load_dataset(path):
+    """Read dataset.csv into (ids, float32 embedding matrix, columnar metadata) skipping rows without embeddings."""
+    ids, vectors = [], []
+    metadata = {key: [] for key in METADATA_COLUMNS}
+    for chunk_ids, chunk_vectors, chunk_metadata, _ in iter_dataset_chunks(path):
+        ids.append(chunk_ids)
+        vectors.append(chunk_vectors)
+        for key, values in chunk_metadata.items():
+            metadata[key].extend(values)
+
+    if not vectors or not sum(len(v) for v in vectors):
+        return np.asarray([], dtype=str), np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32), metadata
+    matrix = np.ascontiguousarray(np.vstack([v for v in vectors if len(v)]), dtype=np.float32)
+    return np.concatenate(ids), matrix, metadata
+
+SNAPSHOT_EMBEDDINGS = 'embeddings.npy'
+SNAPSHOT_IDS = 'ids.npy'
+SNAPSHOT_INV_NORMS = 'inv_norms.npy'  # 1 / row norm, so opening a snapshot never scans the matrix
+SNAPSHOT_METADATA_DIR = 'metadata'
+SNAPSHOT_MANIFEST = 'manifest.json'
+SNAPSHOT_COARSE_DIR = 'coarse'  # derived reduced representation, see two_stage_index.py
+
+
+class SnapshotWriter:
+    """Incrementally write a snapshot directory: a float32 embedding matrix, its inverse row
+    norms, an id array and one array per metadata column, all stored as .npy so they can be
+    memory-mapped."""
+
+    def __init__(self, out_dir, dimension=EMBEDDING_DIMENSION):
+        self.out_dir = out_dir
+        self.dimension = dimension
+        self.count = 0
+        self._ids = []
+        self._metadata = {key: [] for key in METADATA_COLUMNS}
+        os.makedirs(os.path.join(out_dir, SNAPSHOT_METADATA_DIR), exist_ok=True)
+        # A coarse representation derived from the vectors being replaced would no longer match them
+        shutil.rmtree(os.path.join(out_dir, SNAPSHOT_COARSE_DIR), ignore_errors=True)
+        self._raw_path = os.path.join(out_dir, 'embeddings.f32.tmp')
+        self._raw = open(self._raw_path, 'wb')
+
+    def append(self, ids, vectors, metadata):
+        """Append a block of rows; metadata maps each METADATA_COLUMNS key to a list of values."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        self._raw.write(vectors.tobytes())
+        self._ids.extend(str(i) for i in ids)
+        for key in self._metadata:
+            self._metadata[key].extend(str(v) for v in metadata[key])
+        self.count += len(vectors)
+
+    def close(self):
+        """Materialize the .npy files and the manifest; the manifest is written last."""
+        self._raw.close()
+        matrix = np.lib.format.open_memmap(
+            os.path.join(self.out_dir, SNAPSHOT_EMBEDDINGS), mode='w+', dtype=np.float32, shape=(self.count, self.dimension)
+        )
+        inv_norms = np.ones(self.count, dtype=np.float32)
+        if self.count:
+            raw = np.memmap(self._raw_path, dtype=np.float32, mode='r', shape=(self.count, self.dimension))
+            for start in range(0, self.count, 8192):
+                block = raw[start:start + 8192]
+                matrix[start:start + 8192] = block
+                norms = np.linalg.norm(block, axis=1)
+                norms[norms == 0] = 1.0
+                inv_norms[start:start + 8192] = 1.0 / norms
+            del raw
+        matrix.flush()
+        del matrix
+        os.remove(self._raw_path)
+        np.save(os.path.join(self.out_dir, SNAPSHOT_INV_NORMS), inv_norms)
+
+        np.save(os.path.join(self.out_dir, SNAPSHOT_IDS), np.asarray(self._ids, dtype=str))
+        for key, values in self._metadata.items():
+            np.save(os.path.join(self.out_dir, SNAPSHOT_METADATA_DIR, f"{key}.npy"), np.asarray(values, dtype=str))
+        with open(os.path.join(self.out_dir, SNAPSHOT_MANIFEST), 'w') as f:
+            json.dump({
+                "count": self.count,
+                "dimension": self.dimension,
+                "metadata_columns": list(self._metadata),
+                "created": time.time(),
+            }, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._raw.close()
+
+
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, SNAPSHOT_MANIFEST))
+
+def load_snapshot_manifest(snapshot_dir):
+    if not is_snapshot(snapshot_dir):
+        raise FileNotFoundError(f"No snapshot manifest found in {snapshot_dir}")
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)) as f:
+        return json.load(f)
+
+def load_snapshot(snapshot_dir, mmap=True):
+    """Open a snapshot as (ids, embedding matrix, columnar metadata); arrays are memory-mapped unless mmap=False."""
+    manifest = load_snapshot_manifest(snapshot_dir)
+    mmap_mode = 'r' if mmap else None
+    vectors = np.load(os.path.join(snapshot_dir, SNAPSHOT_EMBEDDINGS), mmap_mode=mmap_mode)
+    ids = np.load(os.path.join(snapshot_dir, SNAPSHOT_IDS), mmap_mode=mmap_mode)
+    metadata = {
+        key: np.load(os.path.join(snapshot_dir, SNAPSHOT_METADATA_DIR, f"{key}.npy"), mmap_mode=mmap_mode)
+        for key in manifest["metadata_columns"]
+    }
+    return ids, vectors, metadata
+
+def load_snapshot_inv_norms(snapshot_dir, mmap=True):
+    """Stored inverse row norms of a snapshot, or None for snapshots written before they were stored."""
+    path = os.path.join(snapshot_dir, SNAPSHOT_INV_NORMS)
+    if not os.path.isfile(path):
+        return None
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+def distinct_metadata_values(path, fields, chunksize=CSV_CHUNK_SIZE * 10):
+    """{field: sorted distinct values} read from the metadata columns only, without touching the embeddings."""
+    fields = [field for field in fields if field in METADATA_COLUMNS]
+    if is_snapshot(path):
+        return {
+            field: sorted(np.unique(np.load(os.path.join(path, SNAPSHOT_METADATA_DIR, f"{field}.npy"), mmap_mode='r')).tolist())
+            for field in fields
+        }
+    distinct = {field: set() for field in fields}
+    columns = [METADATA_COLUMNS[field] for field in fields]
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        for field in fields:
+            values = chunk[METADATA_COLUMNS[field]]
+            distinct[field].update(values.astype(str).where(values.notna(), "unknown").unique())
+    return {field: sorted(values) for field, values in distinct.items()}
+
+def iter_dataset(path, chunksize=CSV_CHUNK_SIZE):
+    """Yield (ids, embedding matrix, columnar metadata) blocks from dataset.csv or a snapshot directory."""
+    if is_snapshot(path):
+        ids, vectors, metadata = load_snapshot(path)
+        for start in range(0, len(ids), chunksize):
+            end = start + chunksize
+            yield ids[start:end], np.asarray(vectors[start:end]), {key: values[start:end] for key, values in metadata.items()}
+    else:
+        for ids, vectors, metadata, _ in iter_dataset_chunks(path, chunksize):
+            if len(ids):
+                yield ids, vectors, metadata
+
+def convert_csv_to_snapshot(csv_path, snapshot_dir, chunksize=CSV_CHUNK_SIZE):
+    """One-time conversion of dataset.csv into a snapshot directory, streamed chunk by chunk."""
+    writer = None
+    for ids, vectors, metadata, _ in iter_dataset_chunks(csv_path, chunksize):
+        if not len(ids):
+            continue
+        if writer is None:
+            writer = SnapshotWriter(snapshot_dir, dimension=vectors.shape[1])
+        writer.append(ids, vectors, metadata)
+    if writer is None:
+        writer = SnapshotWriter(snapshot_dir)
+    writer.close()
+    return writer.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert dataset.csv into a memory-mappable embedding snapshot.")
+    parser.add_argument("csv_path", nargs="?", default="dataset.csv")
+    parser.add_argument("snapshot_dir", nargs="?", default="dataset_snapshot")
+    parser.add_argument("--coarse-dim", type=int, default=0, help="also write a reduced-dimension copy for two-stage search (e.g. 256)")
+    parser.add_argument("--coarse-float32", action="store_true", help="keep the reduced copy as float32 instead of int8")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    count = convert_csv_to_snapshot(args.csv_path, args.snapshot_dir)
+    print(f"Wrote {count} vectors to {args.snapshot_dir} in {time.time() - start_time:.2f} seconds")
+    if args.coarse_dim:
+        from two_stage_index import write_coarse
+        start_time = time.time()
+        _, coarse = write_coarse(args.snapshot_dir, args.coarse_dim, quantize=not args.coarse_float32)
+        print(f"Wrote {args.coarse_dim}-d coarse vectors ({coarse.nbytes / 1e6:.1f} MB) in {time.time() - start_time:.2f} seconds")
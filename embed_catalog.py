@@ -0,0 +1,271 @@
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from dataset import CSV_CHUNK_SIZE, ID_COLUMN, METADATA_COLUMNS, SnapshotWriter, metadata_from_frame
+from embedding_cache import normalize_text
+from image_io import EMBED_IMAGE_MAX_SIDE, MULTIMODAL_EMBED_MODEL, fetch_image_bytes, prepare_image_bytes, titan_request_body
+
+load_dotenv()
+dataset_filename = 'dataset.csv'
+NUM_WORKERS = 16           # concurrent fetch + embed workers
+EMBED_RATE = 10.0          # model calls per second
+EMBED_BURST = 20           # token bucket capacity
+MAX_RETRIES = 5            # retries per image on throttling / transient model errors
+NUM_STATUS_PRINT = 500     # after how many images to print status
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException", "ServiceUnavailableException", "ModelNotReadyException",
+    "ModelTimeoutException", "InternalServerException",
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TitanEmbedder:
+    """Titan Multimodal embeddings through Bedrock invoke_model.
+
+    Images get the same downscaling and the same request body as search queries so
+    catalog and query vectors match.
+    """
+
+    def __init__(self, client=None, model_id=MULTIMODAL_EMBED_MODEL, dimension=1024, max_side=EMBED_IMAGE_MAX_SIDE):
+        self.client = client or boto3.client("bedrock-runtime")
+        self.model_id = model_id
+        self.dimension = dimension
+        self.max_side = max_side
+
+    def embed(self, image_bytes=None, text=None):
+        if image_bytes:
+            image_bytes = prepare_image_bytes(image_bytes, self.max_side)
+        response = self.client.invoke_model(
+            body=titan_request_body(image_bytes, normalize_text(text), self.dimension),
+            modelId=self.model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        return json.loads(response.get("body").read())["embedding"]
+
+
+class HashEmbedder:
+    """Deterministic local stand-in for the embedding model, for tests and dry runs.
+
+    Identical inputs map to identical unit vectors; no network calls are made.
+    """
+
+    def __init__(self, dimension=1024):
+        self.dimension = dimension
+
+    def embed(self, image_bytes=None, text=None):
+        digest = hashlib.sha256((image_bytes or b"") + b"\x00" + (text or "").encode("utf-8")).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+        vector = rng.standard_normal(self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def is_retryable_error(error):
+    """True for Bedrock errors worth retrying after a backoff"""
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in RETRYABLE_ERROR_CODES or status in (429, 500, 503)
+
+
+class EmbeddingPipeline:
+    """Fetch, encode and embed catalog images concurrently under a token-bucket rate limit.
+
+    Rows are dicts with "id", "image_path" and "metadata". Results are yielded as
+    (row, embedding) in completion order; failures are counted and skipped.
+    """
+
+    def __init__(self, embedder, workers=NUM_WORKERS, rate=EMBED_RATE, burst=EMBED_BURST,
+                 max_retries=MAX_RETRIES, base_delay=0.5, max_delay=20.0, fetch=fetch_image_bytes):
+        self.embedder = embedder
+        self.workers = workers
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.fetch = fetch
+        self.embedded = 0
+        self.fetch_errors = 0
+        self.embed_errors = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+
+    def run(self, rows):
+        """Yield (row, embedding) for every row that was fetched and embedded successfully"""
+        self.start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = set()
+            for row in rows:
+                pending.add(pool.submit(self._process, row))
+                # Keep a bounded number of rows in flight so the input is streamed
+                if len(pending) >= self.workers * 4:
+                    done = next(as_completed(pending))
+                    pending.remove(done)
+                    result = done.result()
+                    if result is not None:
+                        yield result
+            for done in as_completed(pending):
+                result = done.result()
+                if result is not None:
+                    yield result
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        return {
+            "embedded": self.embedded,
+            "fetch_errors": self.fetch_errors,
+            "embed_errors": self.embed_errors,
+            "retries": self.retries,
+            "elapsed_seconds": elapsed,
+            "images_per_second": self.embedded / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _process(self, row):
+        try:
+            image_bytes = self.fetch(row["image_path"])
+        except Exception as e:
+            print(f"Error fetching image for {row['id']}: {e}")
+            with self._lock:
+                self.fetch_errors += 1
+            return None
+
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                embedding = self.embedder.embed(image_bytes=image_bytes)
+                break
+            except Exception as e:
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    print(f"Error embedding image for {row['id']}: {e}")
+                    with self._lock:
+                        self.embed_errors += 1
+                    return None
+                with self._lock:
+                    self.retries += 1
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                attempt += 1
+
+        with self._lock:
+            self.embedded += 1
+            if self.embedded % NUM_STATUS_PRINT == 0:
+                self._print_status()
+        return row, embedding
+
+    def _print_status(self):
+        stats = self.stats()
+        print(f"Progress: {stats['embedded']} images embedded - {stats['images_per_second']:.1f} images/sec - "
+              f"{stats['fetch_errors']} fetch errors, {stats['embed_errors']} embed errors, {stats['retries']} retries")
+
+
+def iter_catalog_rows(path, chunksize=CSV_CHUNK_SIZE):
+    """Yield {"id", "image_path", "metadata"} rows from a catalog CSV (embedding column not required)"""
+    image_column = METADATA_COLUMNS["img_full_path"]
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        chunk = chunk[chunk[image_column].notna()]
+        metadata = metadata_from_frame(chunk)
+        keys = list(metadata)
+        for position, item_id in enumerate(chunk[ID_COLUMN].astype(str)):
+            row_metadata = {key: metadata[key][position] for key in keys}
+            yield {"id": item_id, "image_path": row_metadata["img_full_path"], "metadata": row_metadata}
+
+def write_snapshot(results, snapshot_dir, dimension, block_size=1000):
+    """Stream (row, embedding) results into a snapshot directory, block by block"""
+    with SnapshotWriter(snapshot_dir, dimension=dimension) as writer:
+        block = []
+
+        def flush():
+            ids = [row["id"] for row, _ in block]
+            metadata = {key: [row["metadata"][key] for row, _ in block] for key in METADATA_COLUMNS}
+            writer.append(ids, np.asarray([embedding for _, embedding in block], dtype=np.float32), metadata)
+            block.clear()
+
+        for result in results:
+            block.append(result)
+            if len(block) >= block_size:
+                flush()
+        if block:
+            flush()
+    return writer.count
+
+def ingest_results(results, workers, max_in_flight):
+    """Stream (row, embedding) results straight into S3 Vectors through the concurrent ingestor"""
+    import ingest_fashion_vectors as ingest
+
+    ingest.create_bucket_and_index()
+    vectors = (
+        {"key": row["id"], "data": {"float32": list(map(float, embedding))}, "metadata": row["metadata"]}
+        for row, embedding in results
+    )
+    return ingest.ingest_concurrently(
+        vectors, ingest.s3vectors, ingest.S3_VECTOR_BUCKET_NAME, ingest.S3_VECTOR_INDEX_NAME,
+        workers=workers, max_in_flight=max_in_flight
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate catalog embeddings from product images.")
+    parser.add_argument("--dataset", default=dataset_filename, help="catalog CSV with id, img_full_path and metadata columns")
+    parser.add_argument("--output", help="write a snapshot directory (see dataset.py)")
+    parser.add_argument("--ingest", action="store_true", help="stream vectors straight into S3 Vectors")
+    parser.add_argument("--embedder", choices=["titan", "local"], default="titan", help="'local' uses a deterministic stand-in")
+    parser.add_argument("--dimension", type=int, default=1024, choices=[256, 384, 1024])
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--rate", type=float, default=EMBED_RATE, help="max model calls per second (0 disables the limit)")
+    parser.add_argument("--burst", type=int, default=EMBED_BURST)
+    parser.add_argument("--ingest-workers", type=int, default=8)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    args = parser.parse_args()
+
+    if bool(args.output) == bool(args.ingest):
+        parser.error("choose exactly one of --output or --ingest")
+
+    embedder = HashEmbedder(args.dimension) if args.embedder == "local" else TitanEmbedder(dimension=args.dimension)
+    pipeline = EmbeddingPipeline(embedder, workers=args.workers, rate=args.rate, burst=args.burst)
+    results = pipeline.run(iter_catalog_rows(args.dataset))
+
+    print("Starting embedding...")
+    if args.output:
+        count = write_snapshot(results, args.output, args.dimension)
+        print(f"Wrote {count} vectors to {args.output}")
+    else:
+        ingest_stats = ingest_results(results, args.ingest_workers, args.max_in_flight)
+        print(f"Ingested {ingest_stats['ingested']} vectors ({ingest_stats['failed']} failed)")
+
+    stats = pipeline.stats()
+    print(f"Total time taken: {stats['elapsed_seconds'] / 60:.2f} minutes ({stats['images_per_second']:.1f} images/sec)")
+    print(f"Embedded: {stats['embedded']} - fetch errors: {stats['fetch_errors']} - embed errors: {stats['embed_errors']} - retries: {stats['retries']}")
+
+if __name__ == "__main__":
+    main()
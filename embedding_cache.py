@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Collapse runs of whitespace so trivially different queries share a cache entry."""
+    return " ".join(text.split()) if text else text
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: an in-memory LRU in front of an on-disk store.
+
+    Entries are keyed on (model_id, dimension, normalized text, image content hash).
+    The disk tier is bounded by total size and entry age; the oldest files are
+    evicted first.
+    """
+
+    def __init__(self, max_memory_items=2048, cache_dir=None, max_disk_bytes=512 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.max_memory_items = max_memory_items
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    @staticmethod
+    def make_key(model_id, dimension, text=None, image_bytes=None):
+        """Build a cache key from the model, output size and the query content."""
+        hasher = hashlib.sha256()
+        hasher.update(f"{model_id}\x00{dimension}\x00".encode("utf-8"))
+        hasher.update((normalize_text(text) or "").encode("utf-8"))
+        hasher.update(b"\x00")
+        if image_bytes:
+            hasher.update(hashlib.sha256(image_bytes).digest())
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        if self.cache_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                created, value = entry
+                with self._lock:
+                    self.disk_hits += 1
+                    # Keep the original creation time so the entry still expires on schedule
+                    self._remember(key, value, created)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store value in both tiers."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+        if self.cache_dir:
+            self._write_disk(key, value, now)
+
+    def stats(self):
+        """Hit/miss counters and tier sizes."""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def clear(self):
+        """Drop every entry from both tiers and reset the counters."""
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+            if self.cache_dir:
+                for path, _, _ in self._disk_entries():
+                    self._remove(path)
+                self._disk_bytes = 0
+
+    def _expired(self, created):
+        return self.ttl_seconds is not None and time.time() - created > self.ttl_seconds
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        """(created, value) for a live disk entry, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry.get("created", 0)):
+            with self._lock:
+                self._remove(path)
+            return None
+        try:
+            os.utime(path)  # refresh mtime so size eviction is least-recently-used
+        except OSError:
+            pass  # evicted by another thread or process since it was read; the value is still good
+        return entry.get("created", 0), entry["value"]
+
+    def _write_disk(self, key, value, created):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": created, "value": value}, f)
+        with self._lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._disk_bytes += os.path.getsize(path) - previous
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """Remove expired entries, then the least recently used ones, until under 90% of the budget.
+
+        Expiry uses each entry's stored creation time (mtime is refreshed on every read,
+        so it only orders the size eviction).
+        """
+        target = int(self.max_disk_bytes * 0.9)
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[1])
+        for path, _, size in entries:
+            if self._disk_bytes <= target and (self.ttl_seconds is None or not self._expired(self._stored_created(path))):
+                continue
+            self._remove(path, size)
+
+    @staticmethod
+    def _stored_created(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("created", 0)
+        except (OSError, ValueError):
+            return 0  # unreadable entries are treated as expired
+
+    def _disk_entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def _remove(self, path, size=None):
+        try:
+            if size is None:
+                size = os.path.getsize(path)
+            os.remove(path)
+            self._disk_bytes = max(0, self._disk_bytes - size)
+        except OSError:
+            pass
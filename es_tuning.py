@@ -0,0 +1,163 @@
+import os
+import json
+import math
+import argparse
+from datetime import datetime, timezone
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+ES_INDEX_NAME = os.environ.get("ES_INDEX_NAME", "fashion-products-index")
+LOCAL_DATASET_PATH = os.environ.get("LOCAL_DATASET_PATH", "dataset.csv")
+ES_TUNING_PROFILE = os.environ.get("ES_TUNING_PROFILE", "./data/es_num_candidates.json")
+
+DEFAULT_NUM_CANDIDATES = 100
+MAX_NUM_CANDIDATES = 10000  # Elasticsearch rejects larger values
+CANDIDATE_GRID = (10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+DEFAULT_KS = (1, 3, 5, 10, 20, 30)
+
+
+class NumCandidatesProfile:
+    """Tuned num_candidates per k for the Elasticsearch kNN query.
+
+    A k that was not tuned uses the entry of the next larger tuned k, or scales the
+    largest one proportionally; without a profile every k gets DEFAULT_NUM_CANDIDATES.
+    """
+
+    def __init__(self, entries=None, target_recall=None, default=DEFAULT_NUM_CANDIDATES):
+        self.entries = {int(k): entry for k, entry in (entries or {}).items()}
+        self.target_recall = target_recall
+        self.default = default
+
+    @classmethod
+    def load(cls, path):
+        """Read a saved profile; a missing or unreadable file gives an empty profile."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls()
+        return cls(data.get("ks", {}), data.get("target_recall"))
+
+    def save(self, path, **info):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        data = {"target_recall": self.target_recall, **info,
+                "ks": {str(k): self.entries[k] for k in sorted(self.entries)}}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+    def num_candidates(self, k):
+        if not self.entries:
+            value = self.default
+        else:
+            larger = [tuned for tuned in self.entries if tuned >= k]
+            if larger:
+                value = self.entries[min(larger)]["num_candidates"]
+            else:
+                largest = max(self.entries)
+                value = math.ceil(self.entries[largest]["num_candidates"] * k / largest)
+        return int(min(MAX_NUM_CANDIDATES, max(k, value)))
+
+
+def candidate_grid(k, grid=CANDIDATE_GRID):
+    return sorted({k, *(value for value in grid if k <= value <= MAX_NUM_CANDIDATES)})
+
+def choose_setting(sweep, target_recall):
+    """Lowest-latency setting meeting the target recall; otherwise the best recall at the fewest candidates."""
+    meeting = [s for s in sweep if s["recall_at_k"] is not None and s["recall_at_k"] >= target_recall]
+    if meeting:
+        return min(meeting, key=lambda s: (s["p50_ms"], s["num_candidates"])), True
+    scored = [s for s in sweep if s["recall_at_k"] is not None]
+    return max(scored, key=lambda s: (s["recall_at_k"], -s["num_candidates"])), False
+
+def tune(client, index_name, tune_embs, tune_truth, ks=DEFAULT_KS, target_recall=0.95, grid=CANDIDATE_GRID,
+         holdout_embs=None, holdout_truth=None):
+    """Sweep num_candidates for every k against exact ground truth and fit a profile.
+
+    Truth lists are the exact top-max(ks) keys per query; the top-k prefix is used for
+    each k. When a holdout set is given, the chosen setting is re-measured on it.
+    """
+    from benchmark import ElasticsearchBackend, benchmark_backend
+
+    entries, sweep = {}, []
+    for k in ks:
+        truth_k = [keys[:k] for keys in tune_truth]
+        results = []
+        for num_candidates in candidate_grid(k, grid):
+            backend = ElasticsearchBackend(client, index_name, num_candidates, name=f"es(k={k},nc={num_candidates})")
+            report = benchmark_backend(backend, tune_embs, truth_k, k)
+            report["num_candidates"] = num_candidates
+            results.append(report)
+            print(f"k={k:<3} num_candidates={num_candidates:<5} recall={report['recall_at_k'] or 0:.3f} "
+                  f"p50={report['p50_ms'] or 0:.2f} ms")
+            if report["recall_at_k"] is not None and report["recall_at_k"] >= 0.9999:
+                break  # more candidates cannot improve recall
+        best, met = choose_setting(results, target_recall)
+        entry = {"num_candidates": best["num_candidates"], "recall_at_k": best["recall_at_k"],
+                 "p50_ms": best["p50_ms"], "met_target": met}
+        if holdout_embs is not None and len(holdout_embs):
+            backend = ElasticsearchBackend(client, index_name, best["num_candidates"], name=f"es(k={k},holdout)")
+            holdout = benchmark_backend(backend, holdout_embs, [keys[:k] for keys in holdout_truth], k)
+            entry.update({"holdout_recall_at_k": holdout["recall_at_k"], "holdout_p50_ms": holdout["p50_ms"]})
+        entries[k] = entry
+        sweep.extend({"k": k, "num_candidates": r["num_candidates"], "recall_at_k": r["recall_at_k"],
+                      "p50_ms": r["p50_ms"], "p95_ms": r["p95_ms"]} for r in results)
+
+    # Keep the profile non-decreasing in k: extra candidates never cost recall, and
+    # measurement noise should not give a larger k fewer candidates than a smaller one
+    floor = 0
+    for k in sorted(entries):
+        if entries[k]["num_candidates"] < floor:
+            entries[k]["num_candidates"] = floor
+            entries[k]["raised_for_monotonicity"] = True
+        floor = entries[k]["num_candidates"]
+    return NumCandidatesProfile(entries, target_recall), sweep
+
+def main():
+    from benchmark import load_queries, sample_queries, embed_queries, ground_truth
+    from local_search import LocalVectorIndex
+    from ingest_es_vectors import create_es_client
+
+    parser = argparse.ArgumentParser(description="Tune the Elasticsearch kNN num_candidates per k against exact ground truth.")
+    parser.add_argument("--queries", help="query file (same format as benchmark.py)")
+    parser.add_argument("--sample-queries", type=int, default=0, help="use N random catalog vectors as queries")
+    parser.add_argument("--dataset", default=LOCAL_DATASET_PATH, help="dataset.csv or snapshot used for exact ground truth")
+    parser.add_argument("--es-index", default=ES_INDEX_NAME)
+    parser.add_argument("--ks", default=",".join(map(str, DEFAULT_KS)))
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--holdout", type=float, default=0.3, help="fraction of queries kept aside to validate the profile")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=ES_TUNING_PROFILE)
+    args = parser.parse_args()
+
+    if not args.queries and not args.sample_queries:
+        parser.error("provide --queries and/or --sample-queries")
+    ks = sorted({int(k) for k in args.ks.split(",") if k.strip()})
+
+    index = LocalVectorIndex.from_path(args.dataset)
+    queries = load_queries(args.queries) if args.queries else []
+    queries += sample_queries(index, args.sample_queries, args.seed) if args.sample_queries else []
+    query_embs = embed_queries(queries)
+    truth = ground_truth(index, query_embs, max(ks))
+
+    order = np.random.default_rng(args.seed).permutation(len(query_embs))
+    holdout_count = int(len(order) * args.holdout)
+    holdout_rows, tune_rows = order[:holdout_count], order[holdout_count:]
+    print(f"Tuning on {len(tune_rows)} queries, validating on {len(holdout_rows)}; target recall {args.target_recall}")
+
+    profile, sweep = tune(
+        create_es_client(), args.es_index, query_embs[tune_rows], [truth[i] for i in tune_rows],
+        ks, args.target_recall, holdout_embs=query_embs[holdout_rows], holdout_truth=[truth[i] for i in holdout_rows]
+    )
+    profile.save(args.output, index=args.es_index, queries=len(query_embs),
+                 created=datetime.now(timezone.utc).isoformat(timespec="seconds"), sweep=sweep)
+
+    for k, entry in sorted(profile.entries.items()):
+        holdout = entry.get("holdout_recall_at_k")
+        print(f"k={k:<3} -> num_candidates={entry['num_candidates']:<5} recall={entry['recall_at_k']:.3f}"
+              f"{f' (holdout {holdout:.3f})' if holdout is not None else ''}"
+              f"{'' if entry['met_target'] else ' [target not met]'}")
+    print(f"Saved profile to {args.output}")
+
+if __name__ == "__main__":
+    main()
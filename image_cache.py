@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from image_io import fetch_image_bytes
+
+THUMBNAIL_SIZE = (400, 400)
+PIN_SECONDS = 60.0      # a returned thumbnail is kept at least this long, so it can still be rendered
+
+
+class ImageCache:
+    """Content-addressed local cache for result images, with pre-resized thumbnails.
+
+    Originals are stored under the SHA-256 of their bytes, so the same image reached
+    through different paths is kept once. A small JSON index maps source paths to
+    digests and tracks last access; the least recently used images are evicted once
+    originals plus thumbnails exceed max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, thumbnail_size=THUMBNAIL_SIZE, fetch=fetch_image_bytes, workers=16):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.fetch = fetch
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pinned = {}  # digest -> time until which eviction must keep it
+        self._index_path = os.path.join(cache_dir, "index.json")
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "thumbs"), exist_ok=True)
+        self._sources, self._blobs = self._load_index()
+
+    def get_thumbnail_path(self, source, evict=True):
+        """Local path of the thumbnail for source, fetching and resizing it on a miss."""
+        with self._lock:
+            digest = self._sources.get(source)
+            entry = self._blobs.get(digest) if digest else None
+            if entry and os.path.exists(self._thumb_path(digest)):
+                entry["last_access"] = time.time()
+                self.hits += 1
+                self._pin(digest)
+                return self._thumb_path(digest)
+            self.misses += 1
+
+        data = self.fetch(source)
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path, thumb_path = self._blob_path(digest), self._thumb_path(digest)
+        if not os.path.exists(thumb_path):
+            thumbnail = _make_thumbnail(data, self.thumbnail_size)
+            _atomic_write(blob_path, data)
+            _atomic_write(thumb_path, thumbnail)
+
+        with self._lock:
+            self._sources[source] = digest
+            self._blobs[digest] = {
+                "size": os.path.getsize(blob_path) + os.path.getsize(thumb_path),
+                "last_access": time.time(),
+            }
+            self._pin(digest)
+            if evict:
+                self._evict(protect={digest})
+        return thumb_path
+
+    def get_image(self, source, thumbnail=True):
+        """PIL image for source: the cached thumbnail, or the full-size original."""
+        thumb_path = self.get_thumbnail_path(source)
+        if thumbnail:
+            return Image.open(thumb_path)
+        return Image.open(self._blob_path(_digest_of(thumb_path)))
+
+    def prefetch(self, sources):
+        """Fetch every source in parallel; returns {source: thumbnail path or the exception raised}."""
+        unique = list(dict.fromkeys(s for s in sources if s))
+        results = {}
+
+        def load(source):
+            try:
+                return source, self.get_thumbnail_path(source, evict=False)
+            except Exception as e:
+                return source, e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(unique) or 1))) as pool:
+            for source, result in pool.map(load, unique):
+                results[source] = result
+        # Evict only after the whole batch is in, and never the images about to be rendered;
+        # digests come from the returned paths, as another session may have evicted the source since
+        with self._lock:
+            self._evict(protect={_digest_of(r) for r in results.values() if isinstance(r, str)})
+        self.save_index()
+        return results
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "images": len(self._blobs),
+                "bytes": sum(entry["size"] for entry in self._blobs.values()),
+            }
+
+    def save_index(self):
+        with self._lock:
+            payload = json.dumps({"sources": self._sources, "blobs": self._blobs})
+        _atomic_write(self._index_path, payload.encode("utf-8"))
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            return index.get("sources", {}), index.get("blobs", {})
+        except (OSError, ValueError):
+            return {}, {}
+
+    def _pin(self, digest):
+        self._pinned[digest] = time.time() + PIN_SECONDS
+
+    def _evict(self, protect=()):
+        now = time.time()
+        self._pinned = {digest: until for digest, until in self._pinned.items() if until > now}
+        total = sum(entry["size"] for entry in self._blobs.values())
+        if total <= self.max_bytes:
+            return
+        for digest in sorted(self._blobs, key=lambda d: self._blobs[d]["last_access"]):
+            if total <= self.max_bytes * 0.9:
+                break
+            if digest in protect or digest in self._pinned:
+                continue
+            total -= self._blobs.pop(digest)["size"]
+            for path in (self._blob_path(digest), self._thumb_path(digest)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._sources = {source: digest for source, digest in self._sources.items() if digest in self._blobs}
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, "blobs", digest)
+
+    def _thumb_path(self, digest):
+        return os.path.join(self.cache_dir, "thumbs", f"{digest}.jpg")
+
+
+def _digest_of(thumb_path):
+    return os.path.basename(thumb_path).rsplit(".", 1)[0]
+
+def _make_thumbnail(data, size):
+    image = Image.open(BytesIO(data))
+    image.thumbnail(size)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+def _atomic_write(path, data):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,157 @@
+import os
+import json
+import base64
+import argparse
+import threading
+from io import BytesIO
+import boto3
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from botocore.config import Config
+from PIL import Image, ImageOps
+from tracing import span
+
+# Connection pool size for the shared S3 client and HTTP session
+POOL_SIZE = 32
+
+# Query and catalog images are downscaled to this longest side before embedding (0 disables it)
+EMBED_IMAGE_MAX_SIDE = int(os.environ.get("EMBED_IMAGE_MAX_SIDE", 512))
+EMBED_IMAGE_QUALITY = 90
+CALIBRATION_SIDES = (224, 256, 384, 512, 768, 1024)
+MULTIMODAL_EMBED_MODEL = 'amazon.titan-embed-image-v1'
+
+_clients_lock = threading.Lock()
+_s3_client = None
+_http_session = None
+
+def get_s3_client():
+    """Shared S3 client, created on first use (boto3 clients are thread-safe)."""
+    global _s3_client
+    with _clients_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3', config=Config(max_pool_connections=POOL_SIZE))
+        return _s3_client
+
+def get_http_session():
+    """Shared requests session with a connection pool sized for parallel fetches."""
+    global _http_session
+    with _clients_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+def fetch_image_bytes(image_path, timeout=30):
+    """Load raw image bytes from a local path, an s3:// URI or an http(s) URL over pooled connections."""
+    if image_path.startswith('s3'):
+        bucket_name, key = image_path.replace("s3://", "").split("/", 1)
+        obj = get_s3_client().get_object(Bucket=bucket_name, Key=key)
+        return obj['Body'].read()
+    elif image_path.startswith(('http://', 'https://')):
+        try:
+            response = get_http_session().get(image_path, timeout=timeout)
+            response.raise_for_status()
+            return response.content
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Error downloading image from URL: {e}")
+    else:
+        with open(image_path, "rb") as image_file:
+            return image_file.read()
+
+def load_image_bytes(image):
+    """Raw bytes of an image given as bytes, or as a local path, s3:// URI or http(s) URL."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    return fetch_image_bytes(image)
+
+def prepare_image_bytes(data, max_side=EMBED_IMAGE_MAX_SIDE, quality=EMBED_IMAGE_QUALITY):
+    """Downscale so the longest side is at most max_side and re-encode as JPEG.
+
+    Returns whichever of the re-encoded and the original bytes is smaller, so small
+    images pass through untouched. Undecodable data is returned as-is for the model
+    to reject.
+    """
+    if not max_side:
+        return data
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except Exception:
+        return data
+    if max(image.size) <= max_side and image.format == "JPEG":
+        return data
+
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode not in ("RGB", "L"):
+        # Flatten transparency onto white, like the catalog product shots
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    encoded = buffer.getvalue()
+    return encoded if len(encoded) < len(data) else data
+
+def titan_request_body(image_bytes, description, dimension):
+    """JSON body for a Titan Multimodal invoke_model call (image already prepared, description normalized).
+
+    Shared by query and catalog embedding so both send identical requests.
+    """
+    payload_body = {}
+    embedding_config = {"embeddingConfig": {"outputEmbeddingLength": dimension}}
+    if image_bytes:
+        with span("encode"):
+            payload_body["inputImage"] = base64.b64encode(image_bytes).decode('utf-8')
+    if description:
+        payload_body["inputText"] = description
+
+    assert payload_body, "please provide either an image and/or a text description"
+    return json.dumps({**payload_body, **embedding_config})
+
+def calibrate_max_side(embed, images, sides=CALIBRATION_SIDES, min_similarity=0.99):
+    """Cosine similarity of embeddings at each max side against the full-resolution originals.
+
+    `embed(image_bytes)` returns a vector. Returns (smallest side whose mean similarity
+    reaches min_similarity or None, {side: {"mean", "min", "mean_bytes"}}).
+    """
+    originals = [load_image_bytes(image) for image in images]
+    reference = [_unit(embed(data)) for data in originals]
+    report, chosen = {}, None
+    for side in sorted(sides):
+        prepared = [prepare_image_bytes(data, side) for data in originals]
+        similarities = [float(np.dot(ref, _unit(embed(data)))) for ref, data in zip(reference, prepared)]
+        report[side] = {
+            "mean": float(np.mean(similarities)),
+            "min": float(np.min(similarities)),
+            "mean_bytes": float(np.mean([len(data) for data in prepared])),
+        }
+        if chosen is None and report[side]["mean"] >= min_similarity:
+            chosen = side
+    return chosen, report
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the smallest EMBED_IMAGE_MAX_SIDE that keeps Titan embeddings close to full resolution.")
+    parser.add_argument("images", nargs="+", help="sample images: local paths, s3:// URIs or URLs")
+    parser.add_argument("--sides", default=",".join(map(str, CALIBRATION_SIDES)))
+    parser.add_argument("--min-similarity", type=float, default=0.99)
+    args = parser.parse_args()
+
+    from utils import get_titan_multimodal_embedding
+    embed = lambda data: get_titan_multimodal_embedding(image_path=data, max_side=0, use_cache=False)["embedding"]
+    chosen, report = calibrate_max_side(embed, args.images, [int(side) for side in args.sides.split(",")], args.min_similarity)
+    mean_original = np.mean([len(load_image_bytes(image)) for image in args.images])
+    print(f"{'max side':>9}{'mean cos':>10}{'min cos':>10}{'bytes':>12}")
+    for side, row in report.items():
+        print(f"{side:>9}{row['mean']:>10.4f}{row['min']:>10.4f}{row['mean_bytes']:>12.0f}")
+    print(f"{'original':>9}{'':>20}{mean_original:>12.0f}")
+    print(f"Smallest side with mean similarity >= {args.min_similarity}: {chosen or 'none, keep full resolution (EMBED_IMAGE_MAX_SIDE=0)'}")
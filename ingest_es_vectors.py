@@ -0,0 +1,132 @@
+import os
+import time
+import argparse
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from elasticsearch import Elasticsearch, helpers, ApiError
+from dataset import EMBEDDING_DIMENSION, iter_dataset
+from metadata_filters import FILTER_FIELDS
+
+load_dotenv()
+ES_ENDPOINT = os.environ.get("ES_ENDPOINT")
+ES_API_KEY = os.environ.get("ES_API_KEY")
+ES_INDEX_NAME = os.environ.get("ES_INDEX_NAME", "fashion-products-index")
+dataset_filename = 'dataset.csv'
+ES_CHUNK_SIZE = 500       # documents per bulk request
+ES_THREAD_COUNT = 4       # parallel bulk requests
+NUM_STATUS_PRINT = 2000   # after how many documents to print status
+
+# Metadata keys written to S3 Vectors are stored under the same names in ES,
+# except the display name which _search_es reads as productDisplayName
+ES_FIELD_NAMES = {"item_name_in_en_us": "productDisplayName"}
+# Every filterable field is mapped as a keyword so the knn filter's terms clauses can match it
+KEYWORD_FIELDS = FILTER_FIELDS
+
+def create_es_client():
+    """Client for ES_ENDPOINT; the API key is optional so a local cluster with security disabled works too"""
+    if not ES_ENDPOINT:
+        raise ConnectionError("Elasticsearch client not configured. Check your .env file for ES_ENDPOINT (and ES_API_KEY if security is enabled).")
+    options = {"api_key": ES_API_KEY} if ES_API_KEY else {}
+    return Elasticsearch(ES_ENDPOINT, request_timeout=120, **options)
+
+def index_mappings(dimension=EMBEDDING_DIMENSION):
+    """Mapping for the fields _search_es queries and returns"""
+    properties = {
+        "id": {"type": "keyword"},
+        "productDisplayName": {"type": "text"},
+        "img_full_path": {"type": "keyword", "index": False},
+        "embedding_img": {
+            "type": "dense_vector",
+            "dims": dimension,
+            "index": True,
+            "similarity": "cosine"
+        }
+    }
+    properties.update({field: {"type": "keyword"} for field in KEYWORD_FIELDS})
+    return {"properties": properties}
+
+def create_index(client, index_name, dimension=EMBEDDING_DIMENSION):
+    """Create the index with a dense_vector mapping if it does not exist yet"""
+    if client.indices.exists(index=index_name):
+        return False
+    client.indices.create(index=index_name, mappings=index_mappings(dimension))
+    return True
+
+@contextmanager
+def bulk_load_settings(client, index_name):
+    """Disable refresh and replicas for the duration of a bulk load, then restore them.
+
+    Serverless projects manage these settings themselves and reject the update, in
+    which case the load simply runs with the defaults.
+    """
+    previous = None
+    try:
+        current = client.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+        # A value of None resets a setting that was not explicitly set back to its default
+        previous = {
+            "refresh_interval": current.get("refresh_interval"),
+            "number_of_replicas": current.get("number_of_replicas"),
+        }
+        client.indices.put_settings(index=index_name, settings={"refresh_interval": "-1", "number_of_replicas": 0})
+    except ApiError as e:
+        print(f"Could not change refresh/replica settings ({e}); loading with the index defaults")
+        previous = None
+
+    try:
+        yield
+    finally:
+        if previous:
+            client.indices.put_settings(index=index_name, settings=previous)
+        client.indices.refresh(index=index_name)
+
+def iter_documents(path, index_name):
+    """Yield bulk index actions for every row of dataset.csv or a snapshot directory"""
+    for ids, vectors, metadata in iter_dataset(path):
+        keys = list(metadata)
+        fields = [ES_FIELD_NAMES.get(key, key) for key in keys]
+        rows = zip(*(metadata[key] for key in keys))
+        for item_id, embedding, values in zip(ids, vectors.tolist(), rows):
+            source = {"id": str(item_id), "embedding_img": embedding}
+            source.update({field: str(value) for field, value in zip(fields, values)})
+            yield {"_index": index_name, "_id": str(item_id), "_source": source}
+
+def bulk_ingest(client, actions, chunk_size=ES_CHUNK_SIZE, thread_count=ES_THREAD_COUNT):
+    """Index actions with parallel bulk requests and return (indexed, failed, elapsed seconds)"""
+    start_time = time.time()
+    indexed, failed = 0, 0
+    for ok, item in helpers.parallel_bulk(
+        client, actions, chunk_size=chunk_size, thread_count=thread_count,
+        queue_size=thread_count * 2, raise_on_error=False, raise_on_exception=False
+    ):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+            print(f"Error indexing a document: {item}")
+
+        if (indexed + failed) % NUM_STATUS_PRINT == 0:
+            elapsed = time.time() - start_time
+            print(f"Progress: {indexed} documents indexed - {indexed / elapsed:.1f} docs/sec - Time elapsed: {elapsed / 60:.2f} minutes")
+    return indexed, failed, time.time() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest the fashion dataset into Elasticsearch.")
+    parser.add_argument("--dataset", default=dataset_filename, help="dataset.csv or a snapshot directory created by dataset.py")
+    parser.add_argument("--index", default=ES_INDEX_NAME)
+    parser.add_argument("--chunk-size", type=int, default=ES_CHUNK_SIZE, help="documents per bulk request")
+    parser.add_argument("--threads", type=int, default=ES_THREAD_COUNT, help="parallel bulk requests")
+    args = parser.parse_args()
+
+    client = create_es_client()
+    if create_index(client, args.index):
+        print(f"Created index {args.index}")
+
+    print("Starting ingesting...")
+    with bulk_load_settings(client, args.index):
+        indexed, failed, elapsed = bulk_ingest(client, iter_documents(args.dataset, args.index), args.chunk_size, args.threads)
+
+    print(f"Total time taken: {elapsed / 60:.2f} minutes ({indexed / elapsed if elapsed else 0:.1f} docs/sec)")
+    print(f"Total documents indexed: {indexed} ({failed} failed)")
+
+if __name__ == "__main__":
+    main()
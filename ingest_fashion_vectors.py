@@ -1,75 +1,107 @@
 import boto3
-import pandas as pd
-import ast
+from botocore.exceptions import ParamValidationError
 import time
 import os
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from dataset import CSV_CHUNK_SIZE, is_snapshot, iter_dataset_chunks, load_snapshot
+from ingest_state import IngestState
 
 load_dotenv()
 S3_VECTOR_BUCKET_NAME = os.environ.get("S3_VECTOR_BUCKET_NAME")
 S3_VECTOR_INDEX_NAME = os.environ.get("S3_VECTOR_INDEX_NAME")
 dataset_filename = 'dataset.csv'
 NUM_VECTORS_PER_PUT = 100  # batch size for put_vectors
+NUM_KEYS_PER_DELETE = 500  # batch size for delete_vectors
 NUM_STATUS_PRINT = 200     # after how many vectors to print status
+NUM_WORKERS = 8            # concurrent put_vectors calls in concurrent mode
+MAX_IN_FLIGHT = 16         # batches submitted but not yet finished in concurrent mode
+MAX_THROTTLE_RETRIES = 6   # retries per request on throttling errors
+RETRY_BASE_DELAY = 0.2     # seconds; backoff ceiling doubles per retry
+RETRY_MAX_DELAY = 10.0     # seconds; cap on a single backoff
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "SlowDown",
+    "RequestLimitExceeded", "ServiceUnavailableException",
+}
+PAYLOAD_ERROR_CODES = {"ValidationException"}  # the request was rejected because of the vectors it carried
+FATAL_ERROR_CODES = {                           # no later batch can succeed either
+    "AccessDeniedException", "NotFoundException", "ResourceNotFoundException",
+    "UnrecognizedClientException", "ExpiredTokenException",
+}
 
 session = boto3.session.Session()
 region = session.region_name
 s3vectors = session.client("s3vectors", region_name=region)
 
-try:
-    s3vectors.create_vector_bucket(vectorBucketName=S3_VECTOR_BUCKET_NAME)
-except s3vectors.exceptions.ConflictException:
-    pass  
-
-try:
-    s3vectors.create_index(
-        vectorBucketName=S3_VECTOR_BUCKET_NAME,
-        indexName=S3_VECTOR_INDEX_NAME,
-        dataType='float32',
-        dimension=1024,
-        distanceMetric='cosine',
-    )
-except s3vectors.exceptions.ConflictException:
-    pass  
-
-# read the dataset from csv
-dataset = pd.read_csv(dataset_filename)
-
-start_time = time.time()
-print("Starting ingesting...")
-
 # Counter for ingested vectors
 ingested_count = 0
-total_rows = len(dataset)
-batch_vectors = []
-
-def create_vector_object(row):
-    """Helper function to create a vector object from a row"""
-    embedding = ast.literal_eval(row['embedding_img'])
-
-    # Skip rows where embedding is just 0 (not a valid array)
-    if embedding == 0:
-        return None
-
-    return {
-        "key": str(row['id']),
-        "data": {"float32": embedding},
-        "metadata": {
-            "gender": str(row['gender']) if pd.notna(row['gender']) else "unknown",
-            "master_category": str(row['masterCategory']) if pd.notna(row['masterCategory']) else "unknown",
-            "sub_category": str(row['subCategory']) if pd.notna(row['subCategory']) else "unknown",
-            "type": str(row['articleType']) if pd.notna(row['articleType']) else "unknown",
-            "base_color": str(row['baseColour']) if pd.notna(row['baseColour']) else "unknown",
-            "season": str(row['season']) if pd.notna(row['season']) else "unknown",
-            "year": str(row['year']) if pd.notna(row['year']) else "unknown",
-            "usage": str(row['usage']) if pd.notna(row['usage']) else "unknown",
-            "item_name_in_en_us": str(row['productDisplayName']) if pd.notna(row['productDisplayName']) else "unknown",
-            "img_full_path": str(row['img_full_path']) if pd.notna(row['img_full_path']) else "unknown"
+total_rows = 0
+start_time = time.time()
+
+def create_bucket_and_index():
+    """Create the vector bucket and index if they do not exist yet"""
+    try:
+        s3vectors.create_vector_bucket(vectorBucketName=S3_VECTOR_BUCKET_NAME)
+    except s3vectors.exceptions.ConflictException:
+        pass
+
+    try:
+        s3vectors.create_index(
+            vectorBucketName=S3_VECTOR_BUCKET_NAME,
+            indexName=S3_VECTOR_INDEX_NAME,
+            dataType='float32',
+            dimension=1024,
+            distanceMetric='cosine',
+        )
+    except s3vectors.exceptions.ConflictException:
+        pass
+
+def vector_objects(ids, vectors, metadata):
+    """Build put_vectors payloads from an id array, an embedding matrix and columnar metadata"""
+    keys = list(metadata)
+    rows = zip(*(metadata[key] for key in keys))
+    return [
+        {
+            "key": str(key),
+            "data": {"float32": embedding},
+            "metadata": {name: str(value) for name, value in zip(keys, values)}
         }
-    }
+        for key, embedding, values in zip(ids, vectors.tolist(), rows)
+    ]
 
-def process_batch(batch):
-    """Process a batch of vectors"""
+def iter_vectors_from_csv(path, chunksize=CSV_CHUNK_SIZE):
+    """Stream vector objects from dataset.csv chunk by chunk, parsing embeddings in bulk"""
+    for ids, vectors, metadata, skipped in iter_dataset_chunks(path, chunksize):
+        for index in skipped:
+            print(f"Skipping row {index} - no embedding available")
+        yield from vector_objects(ids, vectors, metadata)
+
+def iter_vectors_from_snapshot(snapshot_dir, chunksize=CSV_CHUNK_SIZE):
+    """Return an iterator of vector objects from a memory-mapped snapshot (see dataset.py)"""
+    global total_rows
+    ids, vectors, metadata = load_snapshot(snapshot_dir)
+    total_rows = len(ids)
+
+    def chunks():
+        for start in range(0, total_rows, chunksize):
+            end = start + chunksize
+            yield from vector_objects(ids[start:end], vectors[start:end], {key: values[start:end] for key, values in metadata.items()})
+
+    return chunks()
+
+def iter_vectors(path):
+    """Vector objects from dataset.csv or a snapshot directory"""
+    return iter_vectors_from_snapshot(path) if is_snapshot(path) else iter_vectors_from_csv(path)
+
+def iter_vector_batches(path, batch_size=NUM_VECTORS_PER_PUT):
+    """Ready-to-send put_vectors batches from dataset.csv or a snapshot directory"""
+    return iter_batches(iter_vectors(path), batch_size)
+
+def process_batch(batch, on_success=None):
+    """Process a batch of vectors; on_success is called with every part that was stored"""
     global ingested_count
 
     if not batch:  # Skip empty batches
@@ -77,20 +109,23 @@ def process_batch(batch):
 
     try:
         response = s3vectors.put_vectors(
-            vectorBucketName=S3_VECTOR_BUCKET_NAME,   
+            vectorBucketName=S3_VECTOR_BUCKET_NAME,
             indexName=S3_VECTOR_INDEX_NAME,
             vectors=batch
         )
 
         # Increment the counter for successful ingestion
         ingested_count += len(batch)
+        if on_success:
+            on_success(batch)
 
         # Print status every NUM_STATUS_PRINT ingested vectors
         if ingested_count % NUM_STATUS_PRINT < NUM_VECTORS_PER_PUT:
             current_time = time.time()
             elapsed_time_minutes = (current_time - start_time) / 60
-            progress_percentage = ingested_count / total_rows * 100
-            print(f"Progress: {ingested_count} vectors ingested ({progress_percentage:.2f}%) - Time elapsed: {elapsed_time_minutes:.2f} minutes")
+            # total_rows is only known up front for snapshots; CSV input is streamed
+            progress = f" ({ingested_count / total_rows * 100:.2f}%)" if total_rows else ""
+            print(f"Progress: {ingested_count} vectors ingested{progress} - Time elapsed: {elapsed_time_minutes:.2f} minutes")
 
     except Exception as e:
         # If batch fails, try one by one to identify problematic vectors
@@ -98,32 +133,256 @@ def process_batch(batch):
         for vector in batch:
             try:
                 s3vectors.put_vectors(
-                    vectorBucketName=S3_VECTOR_BUCKET_NAME,   
+                    vectorBucketName=S3_VECTOR_BUCKET_NAME,
                     indexName=S3_VECTOR_INDEX_NAME,
                     vectors=[vector]
                 )
                 ingested_count += 1
+                if on_success:
+                    on_success([vector])
             except Exception as e:
                 print(f"Error ingesting a vector: {str(e)}")
 
-# Process the dataset in batches
-for index, row in dataset.iterrows():
-    vector_obj = create_vector_object(row)
+def is_throttling_error(error):
+    """True for botocore errors that signal the service wants us to slow down"""
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLING_ERROR_CODES or status in (429, 503)
+
+def error_code(error):
+    return (getattr(error, 'response', None) or {}).get('Error', {}).get('Code')
+
+def is_payload_error(error):
+    """True when a put_vectors failure is caused by the vectors themselves, so splitting the batch can isolate them"""
+    return isinstance(error, ParamValidationError) or error_code(error) in PAYLOAD_ERROR_CODES
+
+def call_with_retry(call, max_retries=MAX_THROTTLE_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, on_retry=None):
+    """Run call(), retrying throttling errors with full-jitter exponential backoff; on_retry() is called before each retry"""
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as e:
+            if not is_throttling_error(e) or attempt >= max_retries:
+                raise
+            if on_retry:
+                on_retry()
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+            attempt += 1
+
+class ConcurrentIngestor:
+    """Send put_vectors batches from a worker pool with a cap on in-flight batches.
+
+    Throttling errors are retried with full-jitter exponential backoff. A payload
+    validation failure splits the batch in half and retries each half, so a bad vector
+    is isolated in log2(batch size) rounds instead of one call per vector. Any other
+    failure fails the batch as is, and errors such as a missing index or denied access
+    stop the run.
+    """
+
+    def __init__(self, client, bucket_name, index_name, workers=NUM_WORKERS, max_in_flight=MAX_IN_FLIGHT,
+                 max_retries=MAX_THROTTLE_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, on_success=None, total=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.index_name = index_name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_success = on_success
+        self.total = total
+        self.ingested = 0
+        self.failed = 0
+        self.requests = 0
+        self.throttle_retries = 0
+        self.failed_keys = []
+        self.fatal_error = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+        self._last_status = 0
+        self.start_time = time.time()
+
+    def submit(self, batch):
+        """Queue a batch, blocking while max_in_flight batches are outstanding"""
+        if not batch:
+            return
+        if self.fatal_error is not None:
+            raise self.fatal_error
+        self._slots.acquire()
+        future = self._executor.submit(self._ingest, list(batch))
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        pending = []
+        for f in self._futures:
+            if f.done():
+                f.result()  # surface unexpected worker errors
+            else:
+                pending.append(f)
+        self._futures = pending
+
+    def close(self):
+        """Wait for every submitted batch and return the run statistics"""
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+        if self.fatal_error is not None:
+            raise self.fatal_error
+        return self.stats()
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        return {
+            "ingested": self.ingested,
+            "failed": self.failed,
+            "requests": self.requests,
+            "throttle_retries": self.throttle_retries,
+            "elapsed_seconds": elapsed,
+            "vectors_per_second": self.ingested / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _ingest(self, batch):
+        try:
+            self._put_with_retry(batch)
+        except Exception as e:
+            if len(batch) == 1 or not is_payload_error(e):
+                print(f"Error ingesting {len(batch)} vector(s) starting at key {batch[0]['key']}: {str(e)}")
+                with self._lock:
+                    self.failed += len(batch)
+                    self.failed_keys.extend(vector['key'] for vector in batch)
+                    if error_code(e) in FATAL_ERROR_CODES and self.fatal_error is None:
+                        self.fatal_error = e
+                return
+            middle = len(batch) // 2
+            self._ingest(batch[:middle])
+            self._ingest(batch[middle:])
+            return
+
+        if self.on_success:
+            self.on_success(batch)
+        with self._lock:
+            self.ingested += len(batch)
+            if self.ingested - self._last_status >= NUM_STATUS_PRINT:
+                self._last_status = self.ingested
+                self._print_status()
+
+    def _put_with_retry(self, batch):
+        def put():
+            with self._lock:
+                self.requests += 1
+            return self.client.put_vectors(vectorBucketName=self.bucket_name, indexName=self.index_name, vectors=batch)
+
+        return call_with_retry(put, self.max_retries, self.base_delay, self.max_delay, on_retry=self._count_retry)
+
+    def _count_retry(self):
+        with self._lock:
+            self.throttle_retries += 1
+
+    def _print_status(self):
+        elapsed = time.time() - self.start_time
+        rate = self.ingested / elapsed if elapsed > 0 else 0.0
+        progress = f" ({self.ingested / self.total * 100:.2f}%)" if self.total else ""
+        print(f"Progress: {self.ingested} vectors ingested{progress} - {rate:.1f} vectors/sec - Time elapsed: {elapsed / 60:.2f} minutes")
+
+def delete_vectors(keys, client=None, bucket_name=None, index_name=None, batch_size=NUM_KEYS_PER_DELETE, on_success=None):
+    """Delete keys from the index in batches; returns how many were deleted"""
+    client = client or s3vectors
+    bucket_name = bucket_name or S3_VECTOR_BUCKET_NAME
+    index_name = index_name or S3_VECTOR_INDEX_NAME
+    deleted = 0
+    for start in range(0, len(keys), batch_size):
+        batch = list(keys[start:start + batch_size])
+        try:
+            call_with_retry(lambda: client.delete_vectors(vectorBucketName=bucket_name, indexName=index_name, keys=batch))
+        except Exception as e:
+            print(f"Error deleting {len(batch)} vector(s) starting at key {batch[0]}: {str(e)}")
+            continue
+        deleted += len(batch)
+        if on_success:
+            on_success(batch)
+    return deleted
+
+def iter_batches(vectors, batch_size=NUM_VECTORS_PER_PUT):
+    """Group an iterable of vector objects into lists of at most batch_size"""
+    batch = []
+    for vector_obj in vectors:
+        batch.append(vector_obj)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ingest_concurrently(vectors, client, bucket_name, index_name, batch_size=NUM_VECTORS_PER_PUT, **ingestor_options):
+    """Ingest an iterable of vector objects through a ConcurrentIngestor and return its statistics"""
+    ingestor = ConcurrentIngestor(client, bucket_name, index_name, **ingestor_options)
+    try:
+        for batch in iter_batches(vectors, batch_size):
+            ingestor.submit(batch)
+    finally:
+        stats = ingestor.close()
+    return stats
+
+def main():
+    global start_time, ingested_count
+
+    parser = argparse.ArgumentParser(description="Ingest the fashion dataset into S3 Vectors.")
+    parser.add_argument("--dataset", default=dataset_filename, help="dataset.csv or a snapshot directory created by dataset.py")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent put_vectors workers; 1 keeps the sequential loader")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="cap on batches submitted but not yet finished")
+    parser.add_argument("--batch-size", type=int, default=NUM_VECTORS_PER_PUT)
+    parser.add_argument("--state", help="checkpoint file of uploaded keys and content hashes "
+                                        "(default: data/ingest_state/<bucket>__<index>.json)")
+    parser.add_argument("--full", action="store_true", help="upload every vector, even unchanged ones")
+    parser.add_argument("--keep-removed", action="store_true", help="do not delete keys that are no longer in the dataset")
+    args = parser.parse_args()
+
+    create_bucket_and_index()
+
+    start_time = time.time()
+    print("Starting ingesting...")
+
+    # Only new and changed vectors are sent; acknowledged batches are checkpointed as they
+    # complete, so re-running after a crash picks up where the last run stopped
+    state = IngestState(args.state or os.path.join("data", "ingest_state", f"{S3_VECTOR_BUCKET_NAME}__{S3_VECTOR_INDEX_NAME}.json"))
+    vectors = iter_vectors(args.dataset)
+    changed = state.changed(vectors, full=args.full)
+
+    try:
+        if args.workers > 1:
+            stats = ingest_concurrently(
+                changed, s3vectors, S3_VECTOR_BUCKET_NAME, S3_VECTOR_INDEX_NAME,
+                batch_size=args.batch_size, workers=args.workers, max_in_flight=args.max_in_flight,
+                total=total_rows or None, on_success=state.record_put
+            )
+            ingested_count = stats["ingested"]
+            print(f"Throughput: {stats['vectors_per_second']:.1f} vectors/sec over {stats['requests']} requests "
+                  f"({stats['throttle_retries']} throttling retries, {stats['failed']} vectors failed)")
+        else:
+            # Process the dataset in batches
+            for batch_vectors in iter_batches(changed, args.batch_size):
+                process_batch(batch_vectors, on_success=state.record_put)
 
-    if vector_obj is None:
-        print(f"Skipping row {index} - no embedding available")
-        continue
+        # Deletions need a complete pass over the dataset, so they run last
+        removed = state.removed_keys()
+        if removed and not args.keep_removed:
+            print(f"Deleting {len(removed)} vectors no longer in the dataset...")
+            delete_vectors(removed, on_success=state.record_delete)
+    finally:
+        state.close()
 
-    batch_vectors.append(vector_obj)
+    counts = state.counts
+    sent = counts['added'] + counts['changed'] + counts['resent']
+    print(f"Skipped (unchanged): {counts['skipped']} - upserted: {counts['upserted']} of {sent} "
+          f"({counts['added']} new, {counts['changed']} changed, {counts['resent']} unchanged re-sent) - deleted: {counts['deleted']}")
 
-    # When we reach the batch size or the end of the dataset, process the batch
-    if len(batch_vectors) >= NUM_VECTORS_PER_PUT or index == total_rows - 1:
-        process_batch(batch_vectors)
-        batch_vectors = []  # Reset the batch
+    end_time = time.time()
+    elapsed_time_seconds = end_time - start_time
+    elapsed_time_minutes = elapsed_time_seconds / 60
 
-end_time = time.time()
-elapsed_time_seconds = end_time - start_time
-elapsed_time_minutes = elapsed_time_seconds / 60
+    print(f"Total time taken: {elapsed_time_minutes:.2f} minutes")
+    print(f"Total vectors ingested: {ingested_count}")
 
-print(f"Total time taken: {elapsed_time_minutes:.2f} minutes")
-print(f"Total vectors ingested: {ingested_count}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+
+def content_hash(vector_obj):
+    """Hash of a put_vectors payload's embedding and metadata; the key itself is not included."""
+    hasher = hashlib.sha256()
+    hasher.update(np.asarray(vector_obj["data"]["float32"], dtype=np.float32).tobytes())
+    hasher.update(json.dumps(vector_obj.get("metadata", {}), sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()[:32]
+
+
+class IngestState:
+    """Checkpoint of what an index holds: key -> content hash of the last acknowledged upload.
+
+    Acknowledged batches are appended to a journal next to the state file as they
+    complete, so a crashed run resumes by skipping everything already uploaded.
+    compact() folds the journal into the state file at the end of a run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.hashes = {}
+        self.pending = {}
+        self.seen = set()
+        self.counts = {"skipped": 0, "added": 0, "changed": 0, "resent": 0, "upserted": 0, "deleted": 0}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._load()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def changed(self, vectors, full=False):
+        """Yield only new vectors and vectors whose content changed; with full=True yield everything.
+
+        Unchanged vectors sent only because of full=True are counted as "resent", not "changed".
+        """
+        for vector in vectors:
+            key = vector["key"]
+            digest = content_hash(vector)
+            self.seen.add(key)
+            previous = self.hashes.get(key)
+            if previous == digest and not full:
+                self.counts["skipped"] += 1
+                continue
+            if previous is None:
+                self.counts["added"] += 1
+            else:
+                self.counts["changed" if previous != digest else "resent"] += 1
+            with self._lock:
+                self.pending[key] = digest
+            yield vector
+
+    def removed_keys(self):
+        """Keys recorded in the index but absent from the dataset pass that just ran."""
+        return sorted(key for key in self.hashes if key not in self.seen)
+
+    def record_put(self, batch):
+        """Journal a batch the service acknowledged (usable as ConcurrentIngestor's on_success)."""
+        with self._lock:
+            entries = [(vector["key"], self.pending.pop(vector["key"], None) or content_hash(vector)) for vector in batch]
+            self.hashes.update(entries)
+            self.counts["upserted"] += len(entries)
+            self._append([{"op": "put", "key": key, "hash": digest} for key, digest in entries])
+
+    def record_delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self.hashes.pop(key, None)
+            self.counts["deleted"] += len(keys)
+            self._append([{"op": "delete", "key": key} for key in keys])
+
+    def compact(self):
+        """Write the full state atomically and start an empty journal."""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"hashes": self.hashes}, f)
+            os.replace(tmp_path, self.path)
+            self._journal.close()
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+
+    def close(self):
+        self.compact()
+        self._journal.close()
+
+    def _append(self, records):
+        self._journal.write("".join(json.dumps(record) + "\n" for record in records))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.hashes = json.load(f).get("hashes", {})
+        except (OSError, ValueError):
+            self.hashes = {}
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line from a crash
+                    if record["op"] == "put":
+                        self.hashes[record["key"]] = record["hash"]
+                    else:
+                        self.hashes.pop(record["key"], None)
+        except OSError:
+            pass
@@ -0,0 +1,211 @@
+import os
+import time
+import argparse
+import numpy as np
+from local_search import format_result, normalize_rows, top_k
+from dataset import SNAPSHOT_MANIFEST, load_dataset, load_snapshot, is_snapshot
+from metadata_filters import BitmapIndex
+
+DEFAULT_NPROBE = 8
+TRAIN_POINTS_PER_LIST = 256  # k-means training sample size per inverted list
+KMEANS_ITERATIONS = 20
+ASSIGN_BLOCK_ROWS = 8192
+
+
+def npz_path(path):
+    """np.savez appends .npz to paths without it; normalize so existence checks find the saved file."""
+    return path if path.endswith(".npz") else f"{path}.npz"
+
+def dataset_identity(dataset_path):
+    """Path, size and modification time of a dataset.csv or snapshot manifest; changes whenever the dataset is rewritten."""
+    source = os.path.join(dataset_path, SNAPSHOT_MANIFEST) if is_snapshot(dataset_path) else dataset_path
+    stat = os.stat(source)
+    return f"{os.path.abspath(dataset_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+class IVFIndex:
+    """Inverted-file approximate index: a spherical k-means coarse quantizer over unit vectors.
+
+    Every vector lives in the list of its nearest centroid; a query scans only the
+    `nprobe` lists whose centroids are closest to it, trading recall for latency.
+    """
+
+    def __init__(self, centroids, dimension=None):
+        self.centroids = normalize_rows(np.asarray(centroids, dtype=np.float32))
+        self.dimension = dimension or self.centroids.shape[1]
+        self.nlist = len(self.centroids)
+        self.nprobe = DEFAULT_NPROBE
+        self.vectors = np.zeros((0, self.dimension), dtype=np.float32)
+        self.ids = np.asarray([], dtype=str)
+        self.metadata = {}
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.lists = [np.zeros(0, dtype=np.int64) for _ in range(self.nlist)]
+        self.bitmaps = BitmapIndex(self.metadata)
+        self.source = None  # dataset_identity() of the dataset the index was built from
+        self._size = 0
+
+    @classmethod
+    def build(cls, ids, vectors, metadata, nlist=None, iterations=KMEANS_ITERATIONS, seed=0):
+        """Train the coarse quantizer on a sample of vectors, then add all of them."""
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        index = cls(train_centroids(vectors, nlist, iterations, seed))
+        index.add(ids, vectors, metadata)
+        return index
+
+    @classmethod
+    def from_path(cls, dataset_path, nlist=None):
+        """Build from dataset.csv or a snapshot directory."""
+        ids, vectors, metadata = load_snapshot(dataset_path) if is_snapshot(dataset_path) else load_dataset(dataset_path)
+        index = cls.build(ids, vectors, metadata, nlist=nlist)
+        index.source = dataset_identity(dataset_path)
+        return index
+
+    def __len__(self):
+        return self._size
+
+    def add(self, ids, vectors, metadata):
+        """Insert vectors incrementally; they are assigned to the current centroids."""
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension))
+        if not len(vectors):
+            return
+        assignments = self._assign(vectors)
+        start = self._size
+        self._grow(len(vectors))
+        self.vectors[start:start + len(vectors)] = vectors
+        self._size += len(vectors)
+
+        self.ids = np.concatenate([self.ids, np.asarray([str(i) for i in ids])])
+        for key in metadata:
+            current = self.metadata.get(key, np.asarray([], dtype=str))
+            self.metadata[key] = np.concatenate([current, np.asarray([str(v) for v in metadata[key]])])
+        self.assignments = np.concatenate([self.assignments, assignments.astype(np.int32)])
+        self.bitmaps = BitmapIndex(self.metadata)
+
+        new_rows = np.arange(start, start + len(vectors))
+        order = np.argsort(assignments, kind='stable')
+        boundaries = np.searchsorted(assignments[order], np.arange(self.nlist + 1))
+        for list_id in np.unique(assignments):
+            rows = new_rows[order[boundaries[list_id]:boundaries[list_id + 1]]]
+            self.lists[list_id] = np.concatenate([self.lists[list_id], rows])
+
+    def search(self, query_emb, k, nprobe=None, filters=None):
+        return self.search_batch([query_emb], k, nprobe, filters)[0]
+
+    def search_batch(self, query_embs, k, nprobe=None, filters=None):
+        """Top-k cosine search scanning the nprobe closest lists of each query.
+
+        Metadata filters drop non-matching rows from the probed lists before scoring, so
+        a very selective filter may need a larger nprobe to fill k results.
+        """
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = normalize_rows(np.asarray(query_embs, dtype=np.float32).reshape(-1, self.dimension))
+        probes, _ = top_k(queries @ self.centroids.T, nprobe)
+        allowed = self.bitmaps.rows(filters)
+        if allowed is not None:
+            mask = np.zeros(self._size, dtype=bool)
+            mask[allowed] = True
+
+        all_results = []
+        for query, probe in zip(queries, probes):
+            rows = np.concatenate([self.lists[list_id] for list_id in probe])
+            if allowed is not None:
+                rows = rows[mask[rows]]
+            if not len(rows):
+                all_results.append([])
+                continue
+            scores = self.vectors[rows] @ query
+            best, sims = top_k(scores, k)
+            all_results.append([format_result(self.ids, self.metadata, rows[i], sim) for i, sim in zip(best[0], sims[0])])
+        return all_results
+
+    def save(self, path):
+        arrays = {
+            "centroids": self.centroids,
+            "vectors": self.vectors[:self._size],
+            "ids": self.ids,
+            "assignments": self.assignments,
+            "nprobe": np.asarray(self.nprobe),
+        }
+        if self.source is not None:
+            arrays["source"] = np.asarray(self.source)
+        arrays.update({f"metadata__{key}": values for key, values in self.metadata.items()})
+        np.savez(npz_path(path), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(npz_path(path))
+        index = cls(data["centroids"])
+        index.nprobe = int(data["nprobe"])
+        index.source = str(data["source"]) if "source" in data.files else None
+        index.vectors = np.ascontiguousarray(data["vectors"])
+        index._size = len(index.vectors)
+        index.ids = data["ids"]
+        index.assignments = data["assignments"]
+        index.metadata = {name[len("metadata__"):]: data[name] for name in data.files if name.startswith("metadata__")}
+        index.bitmaps = BitmapIndex(index.metadata)
+        order = np.argsort(index.assignments, kind='stable')
+        boundaries = np.searchsorted(index.assignments[order], np.arange(index.nlist + 1))
+        index.lists = [order[boundaries[i]:boundaries[i + 1]].astype(np.int64) for i in range(index.nlist)]
+        return index
+
+    def list_sizes(self):
+        return np.asarray([len(rows) for rows in self.lists])
+
+    def _assign(self, vectors):
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+            block = vectors[start:start + ASSIGN_BLOCK_ROWS]
+            assignments[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def _grow(self, extra):
+        """Amortized growth of the vector matrix so repeated add() calls stay cheap."""
+        needed = self._size + extra
+        if needed <= len(self.vectors):
+            return
+        capacity = max(needed, 2 * len(self.vectors))
+        grown = np.zeros((capacity, self.dimension), dtype=np.float32)
+        grown[:self._size] = self.vectors[:self._size]
+        self.vectors = grown
+
+
+def train_centroids(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means (cosine) on a random training sample."""
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(vectors))
+    sample_size = min(len(vectors), nlist * TRAIN_POINTS_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        counts = np.bincount(assignments, minlength=nlist)
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        empty = counts == 0
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+        if empty.any():
+            # Re-seed empty lists with random training points
+            sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an IVF index from dataset.csv or a snapshot directory.")
+    parser.add_argument("dataset", nargs="?", default="dataset.csv")
+    parser.add_argument("output", nargs="?", default="data/ivf_index.npz")
+    parser.add_argument("--nlist", type=int, default=None, help="number of inverted lists (default: sqrt(n))")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="default lists scanned per query")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    index = IVFIndex.from_path(args.dataset, nlist=args.nlist)
+    index.nprobe = args.nprobe
+    index.save(args.output)
+    args.output = npz_path(args.output)
+    sizes = index.list_sizes()
+    print(f"Built IVF index with {len(index)} vectors in {index.nlist} lists "
+          f"(sizes {sizes.min()}-{sizes.max()}) in {time.time() - start_time:.2f} seconds; saved to {args.output}")
@@ -0,0 +1,110 @@
+import numpy as np
+from dataset import load_dataset, load_snapshot, load_snapshot_inv_norms, is_snapshot
+from metadata_filters import BitmapIndex
+
+# Bound the (queries x rows) score matrix of a batched search to roughly 256 MB
+BATCH_SCORE_BYTES = 256 * 1024 * 1024
+
+
+class LocalVectorIndex:
+    """Exact in-process cosine k-NN over a float32 embedding matrix.
+
+    Serves as an offline search backend and as ground truth for the ANN backends.
+    """
+
+    def __init__(self, ids, vectors, metadata, inv_norms=None):
+        self.ids = np.asarray(ids)
+        self.vectors = vectors if isinstance(vectors, np.memmap) else np.ascontiguousarray(vectors, dtype=np.float32)
+        self.metadata = metadata
+        # Keep the matrix as-is (it may be memory-mapped) and fold the norms into the scores instead
+        if inv_norms is None:
+            norms = np.linalg.norm(self.vectors, axis=1)
+            norms[norms == 0] = 1.0
+            inv_norms = (1.0 / norms).astype(np.float32)
+        self.inv_norms = inv_norms
+        self.bitmaps = BitmapIndex(metadata)
+
+    @classmethod
+    def from_csv(cls, path):
+        ids, vectors, metadata = load_dataset(path)
+        return cls(ids, vectors, metadata)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir, mmap=True):
+        ids, vectors, metadata = load_snapshot(snapshot_dir, mmap=mmap)
+        # Snapshots store the norms, so opening one does not read the whole matrix
+        return cls(ids, vectors, metadata, load_snapshot_inv_norms(snapshot_dir, mmap=mmap))
+
+    @classmethod
+    def from_path(cls, path):
+        """Open a snapshot directory zero-copy, or fall back to parsing dataset.csv."""
+        return cls.from_snapshot(path) if is_snapshot(path) else cls.from_csv(path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dimension(self):
+        return self.vectors.shape[1]
+
+    def search(self, query_emb, k, filters=None):
+        """Top-k cosine search for a single query vector."""
+        return self.search_batch([query_emb], k, filters)[0]
+
+    def search_batch(self, query_embs, k, filters=None):
+        """Top-k cosine search for many query vectors at once, one result list per query.
+
+        With metadata filters only the matching rows (from the bitmap index) are scored.
+        """
+        queries = normalize_rows(np.asarray(query_embs, dtype=np.float32).reshape(-1, self.dimension))
+        allowed = self.bitmaps.rows(filters)
+        candidates = len(self) if allowed is None else len(allowed)
+        k = min(k, candidates)
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        if allowed is None:
+            vectors, inv_norms = self.vectors, self.inv_norms
+        else:
+            vectors, inv_norms = self.vectors[allowed], self.inv_norms[allowed]
+        rows_per_block = max(1, BATCH_SCORE_BYTES // (4 * max(1, candidates)))
+        all_results = []
+        for start in range(0, len(queries), rows_per_block):
+            scores = (queries[start:start + rows_per_block] @ vectors.T) * inv_norms
+            top_rows, top_scores = top_k(scores, k)
+            if allowed is not None:
+                top_rows = allowed[top_rows]
+            for rows, sims in zip(top_rows, top_scores):
+                all_results.append([self.result(row, sim) for row, sim in zip(rows, sims)])
+        return all_results
+
+    def result(self, row, similarity):
+        return format_result(self.ids, self.metadata, row, similarity)
+
+
+def format_result(ids, metadata, row, similarity):
+    """Format a matrix row in the same shape as the Elasticsearch/S3 results."""
+    return {
+        'key': str(ids[row]),
+        'distance': float(1.0 - similarity),
+        'metadata': {key: str(values[row]) for key, values in metadata.items()}
+    }
+
+
+def top_k(scores, k):
+    """Row-wise indices and values of the k largest scores, sorted descending."""
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
@@ -0,0 +1,81 @@
+import threading
+import numpy as np
+
+# Metadata keys that can be filtered on; they are stored under these names in S3 Vectors, ES and the local index
+FILTER_FIELDS = ["gender", "master_category", "sub_category", "type", "base_color", "season", "year", "usage"]
+
+
+def normalize_filters(filters):
+    """{field: value or list of values} -> {field: [str values]}, dropping empty fields.
+
+    Values of one field are OR-ed, fields are AND-ed.
+    """
+    normalized = {}
+    for field, values in (filters or {}).items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter field {field!r}; choose from {', '.join(FILTER_FIELDS)}")
+        if isinstance(values, (str, int, float)):
+            values = [values]
+        values = [str(value) for value in values if value is not None and str(value) != ""]
+        if values:
+            normalized[field] = list(dict.fromkeys(values))
+    return normalized
+
+def to_s3_filter(filters):
+    """S3 Vectors metadata filter document, or None when there is nothing to filter on."""
+    conditions = [
+        {field: {"$eq": values[0]}} if len(values) == 1 else {field: {"$in": values}}
+        for field, values in normalize_filters(filters).items()
+    ]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def to_es_filter(filters):
+    """List of term-level queries for the knn `filter` clause (applied during the ANN search, not after)."""
+    return [{"terms": {field: values}} for field, values in normalize_filters(filters).items()]
+
+
+class BitmapIndex:
+    """Per-field, per-value row-id postings over columnar metadata.
+
+    Postings are built once per field on first use. A filter resolves to the sorted
+    row ids that match it, so filtered search only scores those rows.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self._postings = {}
+        self._lock = threading.Lock()
+
+    def postings(self, field):
+        """{value: sorted int64 row ids} for one metadata field."""
+        with self._lock:
+            if field not in self._postings:
+                values = np.asarray(self.metadata[field]).astype(str)
+                unique, inverse = np.unique(values, return_inverse=True)
+                order = np.argsort(inverse, kind='stable')
+                boundaries = np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1]
+                self._postings[field] = dict(zip(unique.tolist(), np.split(order.astype(np.int64), boundaries)))
+            return self._postings[field]
+
+    def values(self, field):
+        return sorted(self.postings(field))
+
+    def rows(self, filters):
+        """Sorted row ids matching every field of the filter, or None when it is empty."""
+        filters = normalize_filters(filters)
+        if not filters:
+            return None
+        rows = None
+        # Intersect the most selective fields first
+        matches = []
+        for field, values in filters.items():
+            postings = self.postings(field)
+            lists = [postings[value] for value in values if value in postings]
+            matches.append(np.sort(np.concatenate(lists)) if lists else np.zeros(0, dtype=np.int64))
+        for match in sorted(matches, key=len):
+            rows = match if rows is None else np.intersect1d(rows, match, assume_unique=True)
+            if not len(rows):
+                break
+        return rows
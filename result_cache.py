@@ -0,0 +1,121 @@
+import time
+import itertools
+import threading
+from collections import OrderedDict
+import numpy as np
+from metadata_filters import normalize_filters
+
+
+def make_namespace(engine, index, k, filters=None):
+    """Hashable (engine, index, k, filters) key; only queries in the same namespace can share results."""
+    filters_key = tuple(sorted((field, tuple(values)) for field, values in normalize_filters(filters).items()))
+    return engine, index, k, filters_key
+
+
+class SemanticResultCache:
+    """In-memory cache of search results, looked up by embedding similarity.
+
+    A query reuses a cached result list when its unit embedding is within `threshold`
+    cosine similarity of a cached query in the same namespace, so near-identical
+    phrasings ("red dress", "a red dress") skip the backend. Entries expire after
+    `ttl_seconds` and the least recently used are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, threshold=0.98, max_entries=1024, ttl_seconds=600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # entry id -> (namespace, unit vector, results, created)
+        self._namespaces = {}          # namespace -> {"ids": [entry ids], "matrix": stacked vectors or None}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.engine_counts = {}
+
+    def get(self, namespace, query_emb):
+        """Cached results for the closest query within the threshold, or None on a miss."""
+        query = _unit(query_emb)
+        with self._lock:
+            entry_id = self._nearest(namespace, query) if query is not None else None
+            counts = self.engine_counts.setdefault(namespace[0], {"hits": 0, "misses": 0})
+            if entry_id is None:
+                self.misses += 1
+                counts["misses"] += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            counts["hits"] += 1
+            return list(self._entries[entry_id][2])
+
+    def put(self, namespace, query_emb, results):
+        query = _unit(query_emb)
+        if query is None:
+            return
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (namespace, query, list(results), time.time())
+            bucket = self._namespaces.setdefault(namespace, {"ids": [], "matrix": None})
+            bucket["ids"].append(entry_id)
+            bucket["matrix"] = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        """Hit/miss counters overall and per engine, plus entry counts."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "by_engine": {
+                    engine: dict(counts, hit_rate=counts["hits"] / max(1, counts["hits"] + counts["misses"]))
+                    for engine, counts in self.engine_counts.items()
+                },
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._namespaces.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+            self.engine_counts.clear()
+
+    def _nearest(self, namespace, query):
+        bucket = self._namespaces.get(namespace)
+        while bucket and bucket["ids"]:
+            if bucket["matrix"] is None:
+                bucket["matrix"] = np.stack([self._entries[entry_id][1] for entry_id in bucket["ids"]])
+            similarities = bucket["matrix"] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            entry_id = bucket["ids"][best]
+            if time.time() - self._entries[entry_id][3] <= self.ttl_seconds:
+                return entry_id
+            # Expired: drop it and look again among the remaining entries
+            self._remove(entry_id)
+            self.expirations += 1
+            bucket = self._namespaces.get(namespace)
+        return None
+
+    def _remove(self, entry_id):
+        namespace = self._entries.pop(entry_id)[0]
+        bucket = self._namespaces[namespace]
+        bucket["ids"].remove(entry_id)
+        bucket["matrix"] = None
+        if not bucket["ids"]:
+            del self._namespaces[namespace]
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
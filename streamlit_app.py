@@ -3,6 +3,7 @@ import os
 from PIL import Image
 from dotenv import load_dotenv
 from utils import *
+from tracing import tracer, span
 
 def load_css():
     st.markdown("""
@@ -36,6 +37,7 @@ DATASET_IMAGES_LOCATION = os.environ.get("DATASET_IMAGES_LOCATION", "URL")
 S3_VECTOR_BUCKET_NAME = os.environ.get("S3_VECTOR_BUCKET_NAME", "your-s3-bucket")
 S3_VECTOR_INDEX_NAME = os.environ.get("S3_VECTOR_INDEX_NAME", "your-s3-index")
 ES_INDEX_NAME = os.environ.get("ES_INDEX_NAME", "fashion-products-index")
+LOCAL_DATASET_PATH = os.environ.get("LOCAL_DATASET_PATH", "dataset.csv")
 
 def render_home_page():
     st.markdown("<div class='home-container'>", unsafe_allow_html=True)
@@ -43,7 +45,7 @@ def render_home_page():
     st.markdown("Choose a backend to explore search capabilities.")
     st.markdown("</div>", unsafe_allow_html=True)
     st.markdown("<br>", unsafe_allow_html=True)
-    col1, col2 = st.columns(2)
+    col1, col2, col3, col4 = st.columns(4)
     with col1:
         with st.container():
             st.header("📦 S3 Vector Search")
@@ -58,6 +60,36 @@ def render_home_page():
             if st.button("Launch Elasticsearch Search", use_container_width=True):
                 st.session_state.page = 'elasticsearch'
                 st.rerun()
+    with col3:
+        with st.container():
+            st.header("💻 Local Exact Search")
+            st.markdown("")
+            if st.button("Launch Local Search", use_container_width=True):
+                st.session_state.page = 'local_search'
+                st.rerun()
+    with col4:
+        with st.container():
+            st.header("⚖️ Compare Backends")
+            st.markdown("")
+            if st.button("Launch Comparison", use_container_width=True):
+                st.session_state.page = 'compare'
+                st.rerun()
+
+def render_filter_controls(key_prefix, dataset_path=None):
+    """Sidebar metadata filters; values of one field are OR-ed, fields are AND-ed."""
+    with st.spinner("Loading filter values..."):
+        options = get_filter_options(dataset_path)
+    filters = {}
+    with st.expander("Filters"):
+        for field in FILTER_FIELDS:
+            label = field.replace('_', ' ').title()
+            if field in options:
+                filters[field] = st.multiselect(label, options[field], key=f"{key_prefix}_filter_{field}")
+            else:
+                # No local dataset to list the values from; accept comma-separated values
+                text = st.text_input(label, key=f"{key_prefix}_filter_{field}")
+                filters[field] = [value.strip() for value in text.split(",") if value.strip()]
+    return {field: values for field, values in filters.items() if values}
 
 def render_s3_search_page():
     if st.button("⬅️ Back to Home"):
@@ -70,6 +102,7 @@ def render_s3_search_page():
         bucket_name = st.text_input("Vector Bucket Name", value=S3_VECTOR_BUCKET_NAME)
         index_name = st.text_input("Index Name", value=S3_VECTOR_INDEX_NAME)
         k = st.slider("Number of Results", 1, 30, 3, key="s3_k")
+        filters = render_filter_controls("s3")
     st.header("Search Items")
     search_method = st.radio("Search method:", ["Text Search", "Image Search"], horizontal=True, key="s3_method")
     query_prompt, uploaded_image, search_button = None, None, False
@@ -83,7 +116,7 @@ def render_s3_search_page():
             st.image(Image.open(uploaded_image), caption="Uploaded Image", width=300)
         search_button = st.button("🔍 Search", type="primary")
     if search_button:
-        perform_search(search_method, query_prompt, uploaded_image, k, bucket_name, index_name, "S3")
+        perform_search(search_method, query_prompt, uploaded_image, k, bucket_name, index_name, "S3", filters)
 
 def render_elasticsearch_page():
     if st.button("⬅️ Back to Home"):
@@ -95,6 +128,7 @@ def render_elasticsearch_page():
         st.header("Elasticsearch Configuration")
         index_name = st.text_input("Index Name", value=ES_INDEX_NAME)
         k = st.slider("Number of Results", 1, 30, 3, key="es_k")
+        filters = render_filter_controls("es")
     st.header("Search Items")
     search_method = st.radio("Search method:", ["Text Search", "Image Search"], horizontal=True, key="es_method")
     query_prompt, uploaded_image, search_button = None, None, False
@@ -109,9 +143,101 @@ def render_elasticsearch_page():
         search_button = st.button("🔍 Search", type="primary")
     if search_button:
         # For ES, we pass None for bucket_name as it's not needed
-        perform_search(search_method, query_prompt, uploaded_image, k, None, index_name, "Elasticsearch")
+        perform_search(search_method, query_prompt, uploaded_image, k, None, index_name, "Elasticsearch", filters)
 
 
+def render_local_search_page():
+    if st.button("⬅️ Back to Home"):
+        st.session_state.page = 'home'
+        st.rerun()
+    st.title("💻 Local Exact Search")
+    st.markdown("Exact k-NN over the ingested dataset, computed in-process. Use it offline or as ground truth for the other backends. Switch to IVF or Two-stage for approximate search with a tunable recall/latency trade-off.")
+    with st.sidebar:
+        st.header("Local Configuration")
+        dataset_path = st.text_input("Dataset Path", value=LOCAL_DATASET_PATH)
+        k = st.slider("Number of Results", 1, 30, 3, key="local_k")
+        index_type = st.radio("Index Type", ["Exact", "IVF", "Two-stage"], horizontal=True, key="local_index_type",
+                              help="IVF scans only the nprobe closest inverted lists. Two-stage scans compact "
+                                   f"{COARSE_DIMENSION}-d vectors and reranks the best candidates at full dimension.")
+        if index_type == "IVF":
+            ivf_path = st.text_input("IVF Index Path", value=IVF_INDEX_PATH)
+            nprobe = st.slider("nprobe", 1, 64, 8, key="local_nprobe")
+        elif index_type == "Two-stage":
+            candidates = st.slider("Rerank Candidates", 40, 1000, 200, step=20, key="local_candidates",
+                                   help="Never fewer than the number of results.")
+        filters = render_filter_controls("local", dataset_path)
+    st.header("Search Items")
+    search_method = st.radio("Search method:", ["Text Search", "Image Search"], horizontal=True, key="local_method")
+    query_prompt, uploaded_image, search_button = None, None, False
+    if search_method == "Text Search":
+        with st.form(key="local_text_form"):
+            query_prompt = st.text_input("Enter search query:", placeholder="e.g., red dress, blue jeans...")
+            search_button = st.form_submit_button("🔍 Search", type="primary")
+    else:
+        uploaded_image = st.file_uploader("Upload an image:", type=['png', 'jpg', 'jpeg'], key="local_uploader")
+        if uploaded_image:
+            st.image(Image.open(uploaded_image), caption="Uploaded Image", width=300)
+        search_button = st.button("🔍 Search", type="primary")
+    if search_button:
+        if index_type == "IVF":
+            perform_search(search_method, query_prompt, uploaded_image, k, None, (ivf_path, nprobe, dataset_path), "IVF", filters)
+        elif index_type == "Two-stage":
+            perform_search(search_method, query_prompt, uploaded_image, k, None, (dataset_path, candidates), "Two-stage", filters)
+        else:
+            # For the local engine, the "index" is the dataset path
+            perform_search(search_method, query_prompt, uploaded_image, k, None, dataset_path, "Local", filters)
+
+def render_compare_page():
+    if st.button("⬅️ Back to Home"):
+        st.session_state.page = 'home'
+        st.rerun()
+    st.title("⚖️ Compare S3 Vectors and Elasticsearch")
+    st.markdown("The query is embedded once and sent to both backends at the same time.")
+    with st.sidebar:
+        st.header("Compare Configuration")
+        bucket_name = st.text_input("Vector Bucket Name", value=S3_VECTOR_BUCKET_NAME)
+        s3_index_name = st.text_input("S3 Index Name", value=S3_VECTOR_INDEX_NAME)
+        es_index_name = st.text_input("Elasticsearch Index Name", value=ES_INDEX_NAME)
+        k = st.slider("Number of Results", 1, 30, 3, key="compare_k")
+        filters = render_filter_controls("compare")
+    st.header("Search Items")
+    search_method = st.radio("Search method:", ["Text Search", "Image Search"], horizontal=True, key="compare_method")
+    query_prompt, uploaded_image, search_button = None, None, False
+    if search_method == "Text Search":
+        with st.form(key="compare_text_form"):
+            query_prompt = st.text_input("Enter search query:", placeholder="e.g., red dress, blue jeans...")
+            search_button = st.form_submit_button("🔍 Search", type="primary")
+    else:
+        uploaded_image = st.file_uploader("Upload an image:", type=['png', 'jpg', 'jpeg'], key="compare_uploader")
+        if uploaded_image:
+            st.image(Image.open(uploaded_image), caption="Uploaded Image", width=300)
+        search_button = st.button("🔍 Search", type="primary")
+    if search_button:
+        # Compare needs both index names
+        perform_search(search_method, query_prompt, uploaded_image, k, bucket_name, (s3_index_name, es_index_name), "Compare", filters)
+
+def display_comparison(comparison):
+    stats = comparison["stats"]
+    backends = comparison["backends"]
+    sequential_ms = sum(b["query_time_ms"] or 0 for b in backends.values())
+    st.success(
+        f"Embedded once in {comparison['embedding_ms']:.2f} ms; both backends answered in "
+        f"{comparison['wall_time_ms']:.2f} ms wall time (vs {sequential_ms:.2f} ms back to back)"
+    )
+    fmt = lambda value: f"{value:.3f}" if value is not None else "n/a"
+    cols = st.columns(4)
+    cols[0].metric("Shared Items", stats["shared"])
+    cols[1].metric("Overlap@k", fmt(stats["overlap_at_k"]))
+    cols[2].metric("Kendall τ (shared)", fmt(stats["kendall_tau"]))
+    cols[3].metric("Spearman ρ (shared)", fmt(stats["spearman_rho"]))
+
+    for name, backend in backends.items():
+        st.subheader(name)
+        if backend["error"]:
+            st.error(f"{name} search failed: {backend['error']}")
+            continue
+        display_search_results(backend["results"], backend["query_time_ms"], name)
+
 def display_search_results(results, query_time_ms, search_engine):
     if not results:
         st.warning("No results found. Try a different search query/image.")
@@ -119,6 +245,8 @@ def display_search_results(results, query_time_ms, search_engine):
     st.success(f"Found {len(results)} similar items using {search_engine}! (Query time: {query_time_ms:.2f} ms)")
     st.markdown("<div class='results-grid'>", unsafe_allow_html=True)
     sorted_results = sorted(results, key=lambda x: x['distance'])
+    # Fetch every result image in parallel before the grid renders
+    thumbnails = prefetch_result_images(sorted_results)
     for row_start in range(0, len(sorted_results), 3):
         cols = st.columns(3)
         row_items = sorted_results[row_start:row_start + 3]
@@ -131,10 +259,17 @@ def display_search_results(results, query_time_ms, search_engine):
                     item_name = metadata.get('item_name_in_en_us', 'Unknown Item')
                     img_full_path = metadata.get('img_full_path', '')
                     try:
-                        if DATASET_IMAGES_LOCATION == "S3" and img_full_path:
-                            st.image(get_image_from_s3(img_full_path), use_container_width='auto')
-                        elif img_full_path:
-                            st.image(img_full_path, use_container_width='auto')
+                        thumbnail = thumbnails.get(img_full_path)
+                        if isinstance(thumbnail, str) and not os.path.exists(thumbnail):
+                            # Evicted by another session since the prefetch; fetch it once more
+                            thumbnail = get_thumbnail_path(img_full_path)
+                        if isinstance(thumbnail, str):
+                            with span("render"):
+                                st.image(thumbnail, use_container_width='auto')
+                        elif DATASET_IMAGES_LOCATION != "S3" and img_full_path:
+                            # Cache miss that could not be fetched server-side: let the browser try the URL
+                            with span("render"):
+                                st.image(img_full_path, use_container_width='auto')
                         else:
                             st.markdown("🖼️ *Image not available*")
                     except Exception:
@@ -143,36 +278,74 @@ def display_search_results(results, query_time_ms, search_engine):
                     st.markdown(f"`Item ID: {item_id}` | `Score: {distance:.4f}`")
     st.markdown("</div>", unsafe_allow_html=True)
 
-def perform_search(method, query, image, k, bucket_name, index, engine):
+def display_latency_breakdown(trace, container):
+    breakdown = trace.breakdown()
+    if not breakdown:
+        return
+    with container:
+        st.markdown(f"**Latency breakdown** — end-to-end {trace.total_ms:.1f} ms")
+        cols = st.columns(len(breakdown))
+        for col, (stage, duration_ms) in zip(cols, breakdown.items()):
+            col.metric(stage.replace('_', ' ').title(), f"{duration_ms:.1f} ms")
+        with st.expander("Rolling stage latency (this process)"):
+            st.dataframe(tracer.snapshot())
+            st.markdown("**Result cache**")
+            st.json(get_result_cache_stats(), expanded=False)
+            st.download_button("Download Prometheus metrics", tracer.to_prometheus(), file_name="vector_search_metrics.prom")
+            st.download_button("Download JSON metrics", tracer.to_json(), file_name="vector_search_metrics.json")
+
+def perform_search(method, query, image, k, bucket_name, index, engine, filters=None):
     if (method == "Text Search" and not query) or (method == "Image Search" and not image):
         st.warning(f"Please provide input for the {method.lower()}.")
         return
-    with st.spinner(f"Searching with {engine}..."):
+    latency_container = st.container()
+    with st.spinner(f"Searching with {engine}..."), tracer.trace() as trace:
         try:
             results, query_time_ms = None, 0
-            temp_path = None
+            image_bytes = None
             if method == "Image Search":
-                temp_dir = "temp_images"
-                if not os.path.exists(temp_dir): os.makedirs(temp_dir)
-                temp_path = os.path.join(temp_dir, image.name)
-                with open(temp_path, "wb") as f: f.write(image.getbuffer())
+                # The upload stays in memory; it is downscaled before embedding (traced as image_load/resize there)
+                image_bytes = image.getvalue()
 
             if engine == "S3":
                 if method == "Text Search":
-                    results, query_time_ms = search_similar_items_from_text(query, k, bucket_name, index)
+                    results, query_time_ms = search_similar_items_from_text(query, k, bucket_name, index, filters)
                 else:
-                    results, query_time_ms = search_similar_items_from_image(temp_path, k, bucket_name, index)
+                    results, query_time_ms = search_similar_items_from_image(image_bytes, k, bucket_name, index, filters)
             elif engine == "Elasticsearch":
                 if method == "Text Search":
-                    results, query_time_ms = search_similar_items_from_text_es(query, k, index)
+                    results, query_time_ms = search_similar_items_from_text_es(query, k, index, filters)
+                else:
+                    results, query_time_ms = search_similar_items_from_image_es(image_bytes, k, index, filters)
+            elif engine == "Compare":
+                s3_index, es_index = index
+                comparison = search_compare(k, bucket_name, s3_index, es_index, query_prompt=query, image_path=image_bytes, filters=filters)
+            elif engine == "Local":
+                if method == "Text Search":
+                    results, query_time_ms = search_similar_items_from_text_local(query, k, index, filters)
+                else:
+                    results, query_time_ms = search_similar_items_from_image_local(image_bytes, k, index, filters)
+            elif engine == "IVF":
+                ivf_path, nprobe, dataset_path = index
+                if method == "Text Search":
+                    results, query_time_ms = search_similar_items_from_text_ivf(query, k, ivf_path, nprobe, filters, dataset_path)
                 else:
-                    results, query_time_ms = search_similar_items_from_image_es(temp_path, k, index)
-            
-            if temp_path: os.remove(temp_path)
-            display_search_results(results, query_time_ms, engine)
+                    results, query_time_ms = search_similar_items_from_image_ivf(image_bytes, k, ivf_path, nprobe, filters, dataset_path)
+            elif engine == "Two-stage":
+                dataset_path, candidates = index
+                if method == "Text Search":
+                    results, query_time_ms = search_similar_items_from_text_two_stage(query, k, dataset_path, candidates, filters)
+                else:
+                    results, query_time_ms = search_similar_items_from_image_two_stage(image_bytes, k, dataset_path, candidates, filters)
+
+            if engine == "Compare":
+                display_comparison(comparison)
+            else:
+                display_search_results(results, query_time_ms, engine)
         except Exception as e:
             st.error(f"Error during search: {e}")
             st.info("Please check your AWS/Elasticsearch credentials and configuration.")
+    display_latency_breakdown(trace, latency_container)
 
 
 def main():
@@ -184,7 +357,9 @@ def main():
     page_router = {
         'home': render_home_page,
         's3_search': render_s3_search_page,
-        'elasticsearch': render_elasticsearch_page
+        'elasticsearch': render_elasticsearch_page,
+        'local_search': render_local_search_page,
+        'compare': render_compare_page
     }
     page_router[st.session_state.page]()
 
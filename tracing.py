@@ -0,0 +1,150 @@
+import json
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+# Stages of the search path, in the order they usually run
+STAGES = ("image_load", "resize", "encode", "embed", "index_load", "search", "result_mapping", "image_fetch", "render")
+
+# Histogram bucket upper bounds in milliseconds
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class StageHistogram:
+    """Cumulative bucket counts for export plus a rolling window of recent samples for percentiles."""
+
+    def __init__(self, window=1024, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, duration_ms):
+        self.bucket_counts[bisect_left(self.buckets, duration_ms)] += 1
+        self.count += 1
+        self.sum_ms += duration_ms
+        self.recent.append(duration_ms)
+
+    def summary(self):
+        recent = np.asarray(self.recent) if self.recent else None
+        percentiles = np.percentile(recent, [50, 95, 99]) if recent is not None else [None] * 3
+        return {
+            "count": self.count,
+            "sum_ms": self.sum_ms,
+            "mean_ms": self.sum_ms / self.count if self.count else None,
+            "p50_ms": float(percentiles[0]) if recent is not None else None,
+            "p95_ms": float(percentiles[1]) if recent is not None else None,
+            "p99_ms": float(percentiles[2]) if recent is not None else None,
+        }
+
+
+class Trace:
+    """Spans recorded while handling one request."""
+
+    def __init__(self):
+        self.spans = []
+        self.started = time.perf_counter()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, stage, duration_ms):
+        with self._lock:
+            self.spans.append((stage, duration_ms))
+
+    def breakdown(self):
+        """Total milliseconds per stage, in STAGES order followed by any custom stages."""
+        totals = {}
+        with self._lock:
+            for stage, duration_ms in self.spans:
+                totals[stage] = totals.get(stage, 0.0) + duration_ms
+        order = [s for s in STAGES if s in totals] + [s for s in totals if s not in STAGES]
+        return {stage: totals[stage] for stage in order}
+
+    @property
+    def total_ms(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return (end - self.started) * 1000
+
+
+class Tracer:
+    """Records a span per search stage into rolling histograms and the active request trace."""
+
+    def __init__(self, window=1024):
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - start) * 1000)
+
+    def record(self, stage, duration_ms):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = StageHistogram(self.window)
+            histogram.observe(duration_ms)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, duration_ms)
+
+    @contextmanager
+    def trace(self):
+        """Collect the spans of one request; nested spans in this context (and copied contexts) land in it."""
+        trace = Trace()
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            trace.finished = time.perf_counter()
+            _current_trace.reset(token)
+
+    def snapshot(self):
+        """Per-stage count, sum, mean and rolling p50/p95/p99 in milliseconds."""
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, metric="vector_search_stage_duration_seconds"):
+        """Prometheus text exposition of the stage histograms."""
+        lines = [
+            f"# HELP {metric} Latency of each stage of the vector search path.",
+            f"# TYPE {metric} histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound / 1000:g}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.sum_ms / 1000:.6f}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+tracer = Tracer()
+
+def span(stage):
+    """Time a block as `stage` on the default tracer."""
+    return tracer.span(stage)
+
+def current_trace():
+    return _current_trace.get()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from dataset import SNAPSHOT_COARSE_DIR, load_dataset, load_snapshot, load_snapshot_manifest, is_snapshot
+from local_search import format_result, normalize_rows, top_k
+from metadata_filters import BitmapIndex
+
+COARSE_DIR = SNAPSHOT_COARSE_DIR  # sub-directory of a snapshot holding the reduced representation
+DEFAULT_COARSE_DIMENSION = 256
+CANDIDATE_FACTOR = 10            # default candidates kept by the coarse pass, per result
+MIN_CANDIDATES = 100
+PCA_SAMPLE_SIZE = 20000          # vectors used to fit the projection
+SCORE_BLOCK_ROWS = 1024          # rows de-quantized at a time; small enough to stay in cache
+PROJECT_BLOCK_ROWS = 16384       # full vectors normalized and projected at a time when building
+
+
+class CoarseVectors:
+    """Reduced-dimension catalog vectors, as float32 or per-row int8 codes with a scale each."""
+
+    def __init__(self, vectors, scales=None):
+        self.vectors = vectors
+        self.scales = scales
+
+    @classmethod
+    def encode(cls, matrix, quantize=True):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if not quantize:
+            return cls(matrix)
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        return cls(codes, scales.astype(np.float32))
+
+    @property
+    def quantized(self):
+        return self.scales is not None
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + (self.scales.nbytes if self.quantized else 0)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def scores(self, queries, rows=None):
+        """(queries x rows) approximate inner products; rows=None scores every vector."""
+        count = len(self) if rows is None else len(rows)
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        for start in range(0, count, SCORE_BLOCK_ROWS):
+            block_rows = slice(start, start + SCORE_BLOCK_ROWS) if rows is None else rows[start:start + SCORE_BLOCK_ROWS]
+            block = self.vectors[block_rows].astype(np.float32, copy=False)
+            block_scores = queries @ block.T
+            if self.quantized:
+                block_scores *= self.scales[block_rows]
+            scores[:, start:start + len(block)] = block_scores
+        return scores
+
+
+def fit_projection(vectors, dimension=DEFAULT_COARSE_DIMENSION, sample_size=PCA_SAMPLE_SIZE, seed=0):
+    """Top principal directions of the unit catalog vectors, as a (dimension x full dimension) matrix.
+
+    The projection is not centered, so inner products in the reduced space
+    approximate cosine similarities in the full space.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))
+    sample = normalize_rows(np.asarray(vectors[rows], dtype=np.float32))
+    # Eigenvectors of the (full dimension x full dimension) Gram matrix; far cheaper than an SVD of the sample
+    eigenvalues, eigenvectors = np.linalg.eigh(sample.T @ sample)
+    order = np.argsort(eigenvalues)[::-1][:dimension]
+    return np.ascontiguousarray(eigenvectors[:, order].T, dtype=np.float32)
+
+def project(vectors, components, block_rows=PROJECT_BLOCK_ROWS):
+    """Unit-normalize full vectors block by block and project them to the reduced space."""
+    reduced = np.empty((len(vectors), len(components)), dtype=np.float32)
+    for start in range(0, len(vectors), block_rows):
+        block = normalize_rows(np.asarray(vectors[start:start + block_rows], dtype=np.float32))
+        reduced[start:start + len(block)] = block @ components.T
+    return reduced
+
+def write_coarse(snapshot_dir, dimension=DEFAULT_COARSE_DIMENSION, quantize=True):
+    """Add the reduced representation to a snapshot, next to the full 1024-d matrix.
+
+    The coarse manifest records the snapshot's `created` time, so a representation
+    left over from vectors that have since been rewritten is never reused.
+    """
+    snapshot_created = load_snapshot_manifest(snapshot_dir).get("created")
+    _, vectors, _ = load_snapshot(snapshot_dir)
+    components = fit_projection(vectors, dimension)
+    coarse = CoarseVectors.encode(project(vectors, components), quantize)
+    out_dir = os.path.join(snapshot_dir, COARSE_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "components.npy"), components)
+    np.save(os.path.join(out_dir, "vectors.npy"), coarse.vectors)
+    if coarse.quantized:
+        np.save(os.path.join(out_dir, "scales.npy"), coarse.scales)
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump({
+            "dimension": dimension,
+            "quantized": coarse.quantized,
+            "count": len(coarse),
+            "snapshot_created": snapshot_created,
+        }, f, indent=2)
+    return components, coarse
+
+def load_coarse(snapshot_dir):
+    """(components, CoarseVectors, manifest) from a snapshot, or None if it has no coarse representation."""
+    out_dir = os.path.join(snapshot_dir, COARSE_DIR)
+    try:
+        with open(os.path.join(out_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    components = np.load(os.path.join(out_dir, "components.npy"))
+    vectors = np.load(os.path.join(out_dir, "vectors.npy"))
+    scales = np.load(os.path.join(out_dir, "scales.npy")) if manifest["quantized"] else None
+    return components, CoarseVectors(vectors, scales), manifest
+
+
+class TwoStageIndex:
+    """Coarse-to-fine search: a wide candidate pass over compact reduced vectors, then an
+    exact 1024-d rerank of the survivors only.
+
+    Only the reduced vectors (int8 by default) are scanned per query; the full matrix
+    can stay memory-mapped on disk and is read for the candidate rows alone.
+    """
+
+    def __init__(self, ids, vectors, metadata, components, coarse):
+        self.ids = np.asarray(ids)
+        self.vectors = vectors
+        self.metadata = metadata
+        self.components = components
+        self.coarse = coarse
+        self.bitmaps = BitmapIndex(metadata)
+
+    @classmethod
+    def build(cls, ids, vectors, metadata, dimension=DEFAULT_COARSE_DIMENSION, quantize=True):
+        components = fit_projection(vectors, dimension)
+        return cls(ids, vectors, metadata, components, CoarseVectors.encode(project(vectors, components), quantize))
+
+    @classmethod
+    def from_path(cls, path, dimension=DEFAULT_COARSE_DIMENSION, quantize=True):
+        """Use the snapshot's stored coarse representation when it matches; otherwise build one in memory."""
+        if is_snapshot(path):
+            ids, vectors, metadata = load_snapshot(path)
+            stored = load_coarse(path)
+            expected = (dimension, quantize, len(ids), load_snapshot_manifest(path).get("created"))
+            if stored and (stored[2]["dimension"], stored[2]["quantized"], stored[2]["count"], stored[2].get("snapshot_created")) == expected:
+                return cls(ids, vectors, metadata, stored[0], stored[1])
+        else:
+            ids, vectors, metadata = load_dataset(path)
+        return cls.build(ids, vectors, metadata, dimension, quantize)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def coarse_dimension(self):
+        return self.components.shape[0]
+
+    def memory_bytes(self):
+        """Bytes scanned by every query (reduced vectors and projection), against the full matrix."""
+        return {"coarse": self.coarse.nbytes + self.components.nbytes, "full": self.vectors.nbytes}
+
+    def search(self, query_emb, k, candidates=None, filters=None):
+        return self.search_batch([query_emb], k, candidates, filters)[0]
+
+    def search_batch(self, query_embs, k, candidates=None, filters=None):
+        """Top-k cosine search: coarse top-`candidates` (default max(100, 10k)), reranked at full dimension."""
+        queries = normalize_rows(np.asarray(query_embs, dtype=np.float32).reshape(-1, self.vectors.shape[1]))
+        allowed = self.bitmaps.rows(filters)
+        coarse_scores = self.coarse.scores(queries @ self.components.T, allowed)
+        # Never shortlist fewer than k, or the rerank could not return k results
+        candidates = min(max(k, candidates or max(MIN_CANDIDATES, CANDIDATE_FACTOR * k)), coarse_scores.shape[1])
+        if k <= 0 or candidates <= 0:
+            return [[] for _ in range(len(queries))]
+        shortlist, _ = top_k(coarse_scores, candidates)
+
+        all_results = []
+        for query, positions in zip(queries, shortlist):
+            rows = np.sort(positions if allowed is None else allowed[positions])  # sorted for sequential reads
+            full = np.asarray(self.vectors[rows], dtype=np.float32)
+            norms = np.linalg.norm(full, axis=1)
+            norms[norms == 0] = 1.0
+            best, sims = top_k((full @ query) / norms, k)
+            all_results.append([format_result(self.ids, self.metadata, rows[i], sim) for i, sim in zip(best[0], sims[0])])
+        return all_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add a reduced-dimension (optionally int8) representation to a snapshot for two-stage search.")
+    parser.add_argument("snapshot_dir", nargs="?", default="dataset_snapshot")
+    parser.add_argument("--dimension", type=int, default=DEFAULT_COARSE_DIMENSION, help="reduced dimension, e.g. 256 or 384")
+    parser.add_argument("--float32", action="store_true", help="keep the reduced vectors as float32 instead of int8")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    components, coarse = write_coarse(args.snapshot_dir, args.dimension, quantize=not args.float32)
+    print(f"Wrote {len(coarse)} {args.dimension}-d {'int8' if coarse.quantized else 'float32'} vectors "
+          f"({coarse.nbytes / 1e6:.1f} MB) to {os.path.join(args.snapshot_dir, COARSE_DIR)} in {time.time() - start_time:.2f} seconds")
@@ -1,16 +1,26 @@
 import os
 import boto3
 import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import json
-import base64
-from PIL import Image
 from io import BytesIO
 from typing import List, Union
-from sagemaker.s3 import S3Downloader as s3down
-import requests
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch
+from embedding_cache import EmbeddingCache, normalize_text
+from local_search import LocalVectorIndex
+from dataset import distinct_metadata_values
+from ivf_index import IVFIndex, dataset_identity, npz_path
+from two_stage_index import TwoStageIndex, DEFAULT_COARSE_DIMENSION
+from metadata_filters import FILTER_FIELDS, to_s3_filter, to_es_filter
+from es_tuning import NumCandidatesProfile, ES_TUNING_PROFILE
+from result_cache import SemanticResultCache, make_namespace
+from tracing import tracer, span
+from image_cache import ImageCache
+from image_io import EMBED_IMAGE_MAX_SIDE, MULTIMODAL_EMBED_MODEL, load_image_bytes, prepare_image_bytes, titan_request_body
 
 load_dotenv()
 session = boto3.session.Session()
@@ -33,55 +43,96 @@ if ES_ENDPOINT and ES_API_KEY:
         api_key=ES_API_KEY
     )
 
-multimodal_embed_model = 'amazon.titan-embed-image-v1'
+multimodal_embed_model = MULTIMODAL_EMBED_MODEL
+
+embedding_cache = EmbeddingCache(
+    max_memory_items=int(os.environ.get("EMBEDDING_CACHE_MEMORY_ITEMS", 2048)),
+    cache_dir=os.environ.get("EMBEDDING_CACHE_DIR", "./data/embedding_cache") or None,
+    max_disk_bytes=int(os.environ.get("EMBEDDING_CACHE_MAX_MB", 512)) * 1024 * 1024,
+    ttl_seconds=int(os.environ.get("EMBEDDING_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+)
+
 def get_titan_multimodal_embedding(
-    image_path:str=None,
+    image_path:Union[str, bytes]=None,
     description:str=None,
     dimension:int=1024,
-    model_id:str=multimodal_embed_model
+    model_id:str=multimodal_embed_model,
+    use_cache:bool=True,
+    max_side:int=EMBED_IMAGE_MAX_SIDE
 ):
-    payload_body = {}
-    embedding_config = {"embeddingConfig": {"outputEmbeddingLength": dimension}}
-
-    if image_path:
-        # Logic to handle local, S3, or URL images and convert to base64
-        if image_path.startswith('s3'):
-            s3 = boto3.client('s3')
-            bucket_name, key = image_path.replace("s3://", "").split("/", 1)
-            obj = s3.get_object(Bucket=bucket_name, Key=key)
-            base64_image = base64.b64encode(obj['Body'].read()).decode('utf-8')
-            payload_body["inputImage"] = base64_image
-        elif image_path.startswith(('http://', 'https://')):
-            try:
-                response = requests.get(image_path, stream=True)
-                response.raise_for_status()
-                image_content = response.content
-                base64_image = base64.b64encode(image_content).decode('utf-8')
-                payload_body["inputImage"] = base64_image
-            except requests.exceptions.RequestException as e:
-                raise Exception(f"Error downloading image from URL: {e}")
-        else:
-            with open(image_path, "rb") as image_file:
-                input_image = base64.b64encode(image_file.read()).decode('utf8')
-            payload_body["inputImage"] = input_image
-
-    if description:
-        payload_body["inputText"] = description
-
-    assert payload_body, "please provide either an image and/or a text description"
-
-    response = bedrock_client.invoke_model(
-        body=json.dumps({**payload_body, **embedding_config}),
-        modelId=model_id,
-        accept="application/json",
-        contentType="application/json"
-    )
-    return json.loads(response.get("body").read())
+    """Titan Multimodal embedding of a text and/or an image (path, s3:// URI, URL or raw bytes).
 
-def search_similar_items_from_text(query_prompt, k, vector_bucket_name, index_name):
-    query_emb = get_titan_multimodal_embedding(description=query_prompt, dimension=1024)["embedding"]
-    start_time = time.time()
-    response = s3vectors.query_vectors(
+    Images are downscaled to max_side before they are base64-encoded and sent.
+    """
+    image_bytes = None
+    if image_path is not None:
+        with span("image_load"):
+            image_bytes = load_image_bytes(image_path)
+    description = normalize_text(description)
+
+    cache_key = None
+    if use_cache:
+        # Keyed on the original bytes so a hit skips the resize too
+        lookup_start = time.perf_counter()
+        cache_key = EmbeddingCache.make_key(f"{model_id}@{max_side}", dimension, description, image_bytes)
+        cached = embedding_cache.get(cache_key)
+        if cached is not None:
+            tracer.record("embed", (time.perf_counter() - lookup_start) * 1000)
+            return cached
+
+    if image_bytes:
+        with span("resize"):
+            image_bytes = prepare_image_bytes(image_bytes, max_side)
+    body = titan_request_body(image_bytes, description, dimension)
+
+    with span("embed"):
+        response = bedrock_client.invoke_model(
+            body=body,
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        result = json.loads(response.get("body").read())
+    # Outside the span: the put writes to disk and may evict, which is not model latency
+    if cache_key:
+        embedding_cache.put(cache_key, result)
+    return result
+
+def get_embedding_cache_stats():
+    """Hit/miss counters of the query embedding cache."""
+    return embedding_cache.stats()
+
+result_cache = SemanticResultCache(
+    threshold=float(os.environ.get("RESULT_CACHE_THRESHOLD", 0.98)),
+    max_entries=int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 1024)),
+    ttl_seconds=int(os.environ.get("RESULT_CACHE_TTL_SECONDS", 600)),
+)
+
+def get_result_cache_stats():
+    """Hit/miss counters of the semantic result cache, overall and per engine."""
+    return result_cache.stats()
+
+def _cached_search(namespace, query_emb, search, use_cache=True):
+    """Serve a query from the result cache when a near-identical one was seen; otherwise run search() and store it."""
+    if use_cache:
+        start_time = time.time()
+        with span("result_cache"):
+            results = result_cache.get(namespace, query_emb)
+        if results is not None:
+            return results, (time.time() - start_time) * 1000
+    results, query_time_ms = search()
+    if use_cache:
+        result_cache.put(namespace, query_emb, results)
+    return results, query_time_ms
+
+def _search_s3(query_emb, k, vector_bucket_name, index_name, filters=None, use_cache=True):
+    """Helper function to perform k-NN search in S3 Vectors."""
+    namespace = make_namespace("S3", f"{vector_bucket_name}/{index_name}", k, filters)
+    return _cached_search(namespace, query_emb, lambda: _query_s3(query_emb, k, vector_bucket_name, index_name, filters), use_cache)
+
+def _s3_query_request(query_emb, k, vector_bucket_name, index_name, filters=None):
+    """query_vectors arguments, with any metadata filter pushed down."""
+    request = dict(
         vectorBucketName=vector_bucket_name,
         indexName=index_name,
         queryVector={"float32": query_emb},
@@ -89,77 +140,330 @@ def search_similar_items_from_text(query_prompt, k, vector_bucket_name, index_na
         returnDistance=True,
         returnMetadata=True
     )
-    end_time = time.time()
-    query_time_ms = (end_time - start_time) * 1000
-    return response["vectors"], query_time_ms
+    s3_filter = to_s3_filter(filters)
+    if s3_filter:
+        # Filtered inside the index, so the top k are all matching items
+        request["filter"] = s3_filter
+    return request
 
-def search_similar_items_from_image(image_path, k, vector_bucket_name, index_name):
-    query_emb = get_titan_multimodal_embedding(image_path=image_path, dimension=1024)["embedding"]
+def _query_s3(query_emb, k, vector_bucket_name, index_name, filters=None):
     start_time = time.time()
-    response = s3vectors.query_vectors(
-        vectorBucketName=vector_bucket_name,
-        indexName=index_name,
-        queryVector={"float32": query_emb},
-        topK=k,
-        returnDistance=True,
-        returnMetadata=True
-    )
+    response = s3vectors.query_vectors(**_s3_query_request(query_emb, k, vector_bucket_name, index_name, filters))
     end_time = time.time()
     query_time_ms = (end_time - start_time) * 1000
+    tracer.record("search", query_time_ms)
     return response["vectors"], query_time_ms
 
-def _search_es(query_emb, k, index_name):
+def search_similar_items_from_text(query_prompt, k, vector_bucket_name, index_name, filters=None):
+    query_emb = get_titan_multimodal_embedding(description=query_prompt, dimension=1024)["embedding"]
+    return _search_s3(query_emb, k, vector_bucket_name, index_name, filters)
+
+def search_similar_items_from_image(image_path, k, vector_bucket_name, index_name, filters=None):
+    query_emb = get_titan_multimodal_embedding(image_path=image_path, dimension=1024)["embedding"]
+    return _search_s3(query_emb, k, vector_bucket_name, index_name, filters)
+
+# Per-k num_candidates fitted by es_tuning.py; falls back to 100 candidates when no profile exists
+es_num_candidates = NumCandidatesProfile.load(ES_TUNING_PROFILE)
+
+def _search_es(query_emb, k, index_name, filters=None, use_cache=True):
     """Helper function to perform k-NN search in Elasticsearch."""
-    if not es_client:
-        raise ConnectionError("Elasticsearch client not configured. Check your .env file for ES_ENDPOINT and ES_API_KEY.")
+    namespace = make_namespace("Elasticsearch", index_name, k, filters)
+    return _cached_search(namespace, query_emb, lambda: _query_es(query_emb, k, index_name, filters), use_cache)
 
+def _es_knn_query(query_emb, k, filters=None):
+    """kNN clause with the tuned num_candidates and any metadata filter pushed down."""
     knn_query = {
         "field": "embedding_img",  # IMPORTANT: This must match the vector field name in your ES index
         "query_vector": query_emb,
         "k": k,
-        "num_candidates": 100
+        "num_candidates": es_num_candidates.num_candidates(k)
     }
+    es_filter = to_es_filter(filters)
+    if es_filter:
+        # A knn filter is applied during the HNSW search, so k matching hits come back
+        knn_query["filter"] = es_filter
+    return knn_query
+
+ES_SOURCE_FIELDS = ["id", "productDisplayName", "img_full_path"]  # fields returned with each hit
+
+def _es_results(response):
+    """Map ES hits to the same result shape as S3 Vectors."""
+    with span("result_mapping"):
+        results = []
+        for hit in response['hits']['hits']:
+            distance = 1.0 - hit['_score'] # Convert similarity score to distance
+            results.append({
+                'key': hit['_source']['id'],
+                'distance': distance,
+                'metadata': {
+                    'item_name_in_en_us': hit['_source']['productDisplayName'],
+                    'img_full_path': hit['_source']['img_full_path']
+                }
+            })
+    return results
+
+def _query_es(query_emb, k, index_name, filters=None):
+    if not es_client:
+        raise ConnectionError("Elasticsearch client not configured. Check your .env file for ES_ENDPOINT and ES_API_KEY.")
 
     start_time = time.time()
     response = es_client.search(
         index=index_name,
-        knn=knn_query,
-        source=["id", "productDisplayName", "img_full_path"] # Specify fields to return
+        knn=_es_knn_query(query_emb, k, filters),
+        source=ES_SOURCE_FIELDS,
+        size=k  # the default page size of 10 would cut off k > 10
     )
     end_time = time.time()
     query_time_ms = (end_time - start_time) * 1000
+    tracer.record("search", query_time_ms)
+    return _es_results(response), query_time_ms
 
-    results = []
-    for hit in response['hits']['hits']:
-        distance = 1.0 - hit['_score'] # Convert similarity score to distance
-        results.append({
-            'key': hit['_source']['id'],
-            'distance': distance,
-            'metadata': {
-                'item_name_in_en_us': hit['_source']['productDisplayName'],
-                'img_full_path': hit['_source']['img_full_path']
-            }
-        })
-    return results, query_time_ms
-
-def search_similar_items_from_text_es(query_prompt, k, index_name):
+def search_similar_items_from_text_es(query_prompt, k, index_name, filters=None):
     """Search Elasticsearch with a text query."""
     query_emb = get_titan_multimodal_embedding(description=query_prompt, dimension=1024)["embedding"]
-    return _search_es(query_emb, k, index_name)
+    return _search_es(query_emb, k, index_name, filters)
 
-def search_similar_items_from_image_es(image_path, k, index_name):
+def search_similar_items_from_image_es(image_path, k, index_name, filters=None):
     """Search Elasticsearch with an image query."""
     query_emb = get_titan_multimodal_embedding(image_path=image_path, dimension=1024)["embedding"]
-    return _search_es(query_emb, k, index_name)
+    return _search_es(query_emb, k, index_name, filters)
+
+def compare_result_sets(keys_a, keys_b):
+    """Overlap and rank-correlation statistics between two ranked result lists."""
+    keys_a, keys_b = [str(key) for key in keys_a], [str(key) for key in keys_b]
+    shared = [key for key in keys_a if key in set(keys_b)]
+    union = set(keys_a) | set(keys_b)
+    k = max(len(keys_a), len(keys_b))
+    stats = {
+        "shared": len(shared),
+        "overlap_at_k": len(shared) / k if k else 0.0,
+        "jaccard": len(shared) / len(union) if union else 0.0,
+        "kendall_tau": None,
+        "spearman_rho": None,
+    }
+    if len(shared) >= 2:
+        rank_a = {key: rank for rank, key in enumerate(keys_a)}
+        rank_b = {key: rank for rank, key in enumerate(keys_b)}
+        # Ranks restricted to the shared items, so both lists are permutations of 0..n-1
+        order_a = sorted(shared, key=rank_a.get)
+        order_b = sorted(shared, key=rank_b.get)
+        position_b = {key: i for i, key in enumerate(order_b)}
+        ranks = [position_b[key] for key in order_a]
+        n = len(ranks)
+        concordant = sum(1 for i in range(n) for j in range(i + 1, n) if ranks[i] < ranks[j])
+        pairs = n * (n - 1) / 2
+        stats["kendall_tau"] = (2 * concordant - pairs) / pairs
+        stats["spearman_rho"] = 1 - 6 * sum((i - r) ** 2 for i, r in enumerate(ranks)) / (n * (n * n - 1))
+    return stats
+
+def search_compare(k, vector_bucket_name, s3_index_name, es_index_name, query_prompt=None, image_path=None, filters=None):
+    """Embed a query once and send it to S3 Vectors and Elasticsearch concurrently.
+
+    Total wall time is roughly the slower of the two backends instead of their sum.
+    """
+    embed_start = time.time()
+    query_emb = get_titan_multimodal_embedding(image_path=image_path, description=query_prompt, dimension=1024)["embedding"]
+    embedding_ms = (time.time() - embed_start) * 1000
+
+    searches = {
+        # Bypass the result cache so both backends are actually timed
+        "S3": lambda: _search_s3(query_emb, k, vector_bucket_name, s3_index_name, filters, use_cache=False),
+        "Elasticsearch": lambda: _search_es(query_emb, k, es_index_name, filters, use_cache=False),
+    }
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=len(searches)) as pool:
+        # Copy the context so spans recorded in the workers reach the caller's trace
+        futures = {name: pool.submit(contextvars.copy_context().run, search) for name, search in searches.items()}
+        backends = {}
+        for name, future in futures.items():
+            try:
+                results, query_time_ms = future.result()
+                backends[name] = {"results": results, "query_time_ms": query_time_ms, "error": None}
+            except Exception as e:
+                backends[name] = {"results": [], "query_time_ms": None, "error": str(e)}
+    wall_time_ms = (time.time() - start_time) * 1000
+
+    return {
+        "embedding_ms": embedding_ms,
+        "wall_time_ms": wall_time_ms,
+        "backends": backends,
+        "stats": compare_result_sets(
+            [r['key'] for r in backends["S3"]["results"]],
+            [r['key'] for r in backends["Elasticsearch"]["results"]]
+        ),
+    }
+
+LOCAL_DATASET_PATH = os.environ.get("LOCAL_DATASET_PATH", "dataset.csv")
+_local_indexes = {}
+_local_indexes_lock = threading.Lock()
+
+def get_local_index(dataset_path=None):
+    """Load (once per process) the exact local index for a dataset.csv or snapshot directory."""
+    dataset_path = dataset_path or LOCAL_DATASET_PATH
+    with _local_indexes_lock:
+        if dataset_path not in _local_indexes:
+            if not os.path.exists(dataset_path):
+                raise FileNotFoundError(f"Local dataset not found at {dataset_path}. Set LOCAL_DATASET_PATH in your .env file.")
+            with span("index_load"):
+                _local_indexes[dataset_path] = LocalVectorIndex.from_path(dataset_path)
+        return _local_indexes[dataset_path]
+
+def _search_local(query_emb, k, dataset_path=None, filters=None, use_cache=True):
+    """Helper function to perform exact k-NN search over the local dataset."""
+    namespace = make_namespace("Local", dataset_path or LOCAL_DATASET_PATH, k, filters)
+    return _cached_search(namespace, query_emb, lambda: _query_local(query_emb, k, dataset_path, filters), use_cache)
+
+def _query_local(query_emb, k, dataset_path=None, filters=None):
+    index = get_local_index(dataset_path)
+    start_time = time.time()
+    results = index.search(query_emb, k, filters=filters)
+    end_time = time.time()
+    query_time_ms = (end_time - start_time) * 1000
+    tracer.record("search", query_time_ms)
+    return results, query_time_ms
+
+def search_similar_items_from_text_local(query_prompt, k, dataset_path=None, filters=None):
+    """Search the local exact index with a text query."""
+    query_emb = get_titan_multimodal_embedding(description=query_prompt, dimension=1024)["embedding"]
+    return _search_local(query_emb, k, dataset_path, filters)
+
+def search_similar_items_from_image_local(image_path, k, dataset_path=None, filters=None):
+    """Search the local exact index with an image query."""
+    query_emb = get_titan_multimodal_embedding(image_path=image_path, dimension=1024)["embedding"]
+    return _search_local(query_emb, k, dataset_path, filters)
+
+_filter_options = {}
+
+def get_filter_options(dataset_path=None):
+    """Distinct values per filterable field of the local dataset; empty if no local dataset is available.
+
+    Only the metadata columns are read, so the remote-backend pages do not load the embeddings.
+    """
+    dataset_path = dataset_path or LOCAL_DATASET_PATH
+    with _local_indexes_lock:
+        if dataset_path not in _filter_options:
+            if not os.path.exists(dataset_path):
+                return {}
+            index = _local_indexes.get(dataset_path)
+            if index is not None:
+                options = {field: index.bitmaps.values(field) for field in FILTER_FIELDS if field in index.metadata}
+            else:
+                options = distinct_metadata_values(dataset_path, FILTER_FIELDS)
+            _filter_options[dataset_path] = options
+        return _filter_options[dataset_path]
+
+IVF_INDEX_PATH = os.environ.get("IVF_INDEX_PATH", "./data/ivf_index.npz")
+_ivf_indexes = {}
+
+def get_ivf_index(index_path=None, dataset_path=None):
+    """Load (once per process) the IVF index for a dataset; (re)build and save it if missing or built from another dataset."""
+    index_path = npz_path(index_path or IVF_INDEX_PATH)
+    dataset_path = dataset_path or LOCAL_DATASET_PATH
+    key = (index_path, dataset_path)
+    with _local_indexes_lock:
+        if key not in _ivf_indexes:
+            with span("index_load"):
+                dataset_exists = os.path.exists(dataset_path)
+                index = IVFIndex.load(index_path) if os.path.exists(index_path) else None
+                # A saved index without its dataset is still usable; with it, it must match the current contents
+                if index is None or (dataset_exists and index.source != dataset_identity(dataset_path)):
+                    if not dataset_exists:
+                        raise FileNotFoundError(f"Local dataset not found at {dataset_path}. Set LOCAL_DATASET_PATH in your .env file.")
+                    index = IVFIndex.from_path(dataset_path)
+                    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+                    index.save(index_path)
+                _ivf_indexes[key] = index
+        return _ivf_indexes[key]
+
+def _search_ivf(query_emb, k, index_path=None, nprobe=None, filters=None, use_cache=True, dataset_path=None):
+    """Helper function to perform approximate k-NN search with the IVF index."""
+    namespace = make_namespace("IVF", (index_path or IVF_INDEX_PATH, nprobe, dataset_path or LOCAL_DATASET_PATH), k, filters)
+    return _cached_search(namespace, query_emb, lambda: _query_ivf(query_emb, k, index_path, nprobe, filters, dataset_path), use_cache)
+
+def _query_ivf(query_emb, k, index_path=None, nprobe=None, filters=None, dataset_path=None):
+    index = get_ivf_index(index_path, dataset_path)
+    start_time = time.time()
+    results = index.search(query_emb, k, nprobe=nprobe, filters=filters)
+    end_time = time.time()
+    query_time_ms = (end_time - start_time) * 1000
+    tracer.record("search", query_time_ms)
+    return results, query_time_ms
+
+def search_similar_items_from_text_ivf(query_prompt, k, index_path=None, nprobe=None, filters=None, dataset_path=None):
+    """Search the local IVF index with a text query."""
+    query_emb = get_titan_multimodal_embedding(description=query_prompt, dimension=1024)["embedding"]
+    return _search_ivf(query_emb, k, index_path, nprobe, filters, dataset_path=dataset_path)
+
+def search_similar_items_from_image_ivf(image_path, k, index_path=None, nprobe=None, filters=None, dataset_path=None):
+    """Search the local IVF index with an image query."""
+    query_emb = get_titan_multimodal_embedding(image_path=image_path, dimension=1024)["embedding"]
+    return _search_ivf(query_emb, k, index_path, nprobe, filters, dataset_path=dataset_path)
+
+COARSE_DIMENSION = int(os.environ.get("COARSE_DIMENSION", DEFAULT_COARSE_DIMENSION))
+COARSE_INT8 = os.environ.get("COARSE_INT8", "true").lower() in ("1", "true", "yes")
+_two_stage_indexes = {}
+
+def get_two_stage_index(dataset_path=None, dimension=None, quantize=None):
+    """Load (once per process) the coarse-to-fine index; uses the snapshot's coarse/ representation when present."""
+    dataset_path = dataset_path or LOCAL_DATASET_PATH
+    dimension = dimension or COARSE_DIMENSION
+    quantize = COARSE_INT8 if quantize is None else quantize
+    key = (dataset_path, dimension, quantize)
+    with _local_indexes_lock:
+        if key not in _two_stage_indexes:
+            if not os.path.exists(dataset_path):
+                raise FileNotFoundError(f"Local dataset not found at {dataset_path}. Set LOCAL_DATASET_PATH in your .env file.")
+            with span("index_load"):
+                _two_stage_indexes[key] = TwoStageIndex.from_path(dataset_path, dimension, quantize)
+        return _two_stage_indexes[key]
+
+def _search_two_stage(query_emb, k, dataset_path=None, candidates=None, filters=None, use_cache=True):
+    """Helper function to perform coarse-to-fine k-NN search: reduced-dimension candidates, full-dimension rerank."""
+    namespace = make_namespace("Two-stage", (dataset_path or LOCAL_DATASET_PATH, COARSE_DIMENSION, COARSE_INT8, candidates), k, filters)
+    return _cached_search(namespace, query_emb, lambda: _query_two_stage(query_emb, k, dataset_path, candidates, filters), use_cache)
+
+def _query_two_stage(query_emb, k, dataset_path=None, candidates=None, filters=None):
+    index = get_two_stage_index(dataset_path)
+    start_time = time.time()
+    results = index.search(query_emb, k, candidates=candidates, filters=filters)
+    end_time = time.time()
+    query_time_ms = (end_time - start_time) * 1000
+    tracer.record("search", query_time_ms)
+    return results, query_time_ms
+
+def search_similar_items_from_text_two_stage(query_prompt, k, dataset_path=None, candidates=None, filters=None):
+    """Search the local coarse-to-fine index with a text query."""
+    query_emb = get_titan_multimodal_embedding(description=query_prompt, dimension=1024)["embedding"]
+    return _search_two_stage(query_emb, k, dataset_path, candidates, filters)
+
+def search_similar_items_from_image_two_stage(image_path, k, dataset_path=None, candidates=None, filters=None):
+    """Search the local coarse-to-fine index with an image query."""
+    query_emb = get_titan_multimodal_embedding(image_path=image_path, dimension=1024)["embedding"]
+    return _search_two_stage(query_emb, k, dataset_path, candidates, filters)
+
+image_cache = ImageCache(
+    os.environ.get("IMAGE_CACHE_DIR", "./data/image_cache"),
+    max_bytes=int(os.environ.get("IMAGE_CACHE_MAX_MB", 1024)) * 1024 * 1024,
+)
 
 def get_image_from_s3(image_full_path):
     if image_full_path.startswith('s3'):
-        local_data_root = './data/images'
-        if not os.path.exists(local_data_root):
-            os.makedirs(local_data_root)
-        local_file_name = image_full_path.split('/')[-1]
-        s3down.download(image_full_path, local_data_root)
-        local_image_path = os.path.join(local_data_root, local_file_name)
-        return Image.open(local_image_path)
+        with span("image_fetch"):
+            return image_cache.get_image(image_full_path)
     return None
 
+def prefetch_result_images(results):
+    """Fetch every result image of a query in parallel; returns {img_full_path: thumbnail path or exception}."""
+    paths = [r.get('metadata', {}).get('img_full_path') for r in results]
+    with span("image_fetch"):
+        return image_cache.prefetch([p for p in paths if p and p != "unknown"])
+
+def get_thumbnail_path(image_full_path):
+    """Local thumbnail path for one result image, fetching it again if it is not cached."""
+    with span("image_fetch"):
+        return image_cache.get_thumbnail_path(image_full_path)
+
+def get_latency_metrics(fmt="json"):
+    """Rolling per-stage latency histograms as JSON or Prometheus text."""
+    return tracer.to_prometheus() if fmt == "prometheus" else tracer.to_json()
+